@@ -0,0 +1,139 @@
+import asyncio
+import io
+import json
+import logging
+import sys
+
+from flask_restful import Resource
+
+from main import api, app, create_app
+from scoring_pool import BoundedPool, PoolSaturated
+
+logger = logging.getLogger(__name__)
+
+# Requests that rank recommendations, run on the bounded scoring pool so they cannot starve the other endpoints
+SCORING_ROUTES = {
+    ('GET', '/recommend/recipe'),
+    ('POST', '/recommend/recipe/batch'),
+    ('GET', '/recommend/exercise'),
+}
+
+scoring_pool = BoundedPool('scoring', max_workers=app.config['SCORING_WORKERS'], max_pending=app.config['SCORING_MAX_PENDING'],
+                           timeout=app.config['SCORING_TIMEOUT'])
+handler_pool = BoundedPool('handler', max_workers=app.config['HANDLER_WORKERS'], max_pending=4 * app.config['HANDLER_WORKERS'])
+
+class ServingPoolStats(Resource):
+    def get(self):
+        return {'scoring': scoring_pool.stats(), 'handler': handler_pool.stats()}
+
+api.add_resource(ServingPoolStats, "/health/pools")
+
+def wsgi_environ(scope, body):
+    """
+    Builds the WSGI environ of an ASGI HTTP request.
+    """
+    server_name, server_port = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf8').decode('latin1'),
+        'PATH_INFO': scope['path'].encode('utf8').decode('latin1'),
+        'QUERY_STRING': scope['query_string'].decode('latin1'),
+        'SERVER_NAME': server_name,
+        'SERVER_PORT': str(server_port),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'REMOTE_ADDR': scope['client'][0] if scope.get('client') else '',
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope['headers']:
+        name = name.decode('latin1').upper().replace('-', '_')
+        value = value.decode('latin1')
+        if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            name = 'HTTP_' + name
+        environ[name] = f"{environ[name]},{value}" if name in environ else value
+    # The body has been read in full, which also covers requests sent without a Content-Length
+    environ['CONTENT_LENGTH'] = str(len(body))
+    return environ
+
+def call_wsgi(environ):
+    """
+    Runs the Flask app on one request and returns its status code, headers and body.
+    """
+    response = {}
+    def start_response(status, headers, exc_info=None):
+        response['status'] = int(status.split(' ', 1)[0])
+        response['headers'] = [(name.lower().encode('latin1'), value.encode('latin1')) for name, value in headers]
+    chunks = app(environ, start_response)
+    try:
+        body = b''.join(chunks)
+    finally:
+        if hasattr(chunks, 'close'):
+            chunks.close()
+    return response['status'], response['headers'], body
+
+def error_response(status, error, headers=()):
+    # Same shape as the errors the resources abort with
+    body = json.dumps({'message': {'error': error}}).encode()
+    return status, [(b'content-type', b'application/json'), (b'content-length', str(len(body)).encode()), *headers], body
+
+async def read_body(receive):
+    body = bytearray()
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return None
+        body += message.get('body', b'')
+        if not message.get('more_body'):
+            return bytes(body)
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            try:
+                await asyncio.get_running_loop().run_in_executor(None, create_app)
+            except Exception as error:
+                logger.exception("Starting the app failed")
+                await send({'type': 'lifespan.startup.failed', 'message': str(error)})
+                return
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            scoring_pool.shutdown()
+            handler_pool.shutdown()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+async def application(scope, receive, send):
+    """
+    ASGI entry point serving the Flask app, e.g. with uvicorn asgi:application. The server's lifespan
+    startup runs create_app.
+
+    Connections are handled on the event loop, and each request runs on a thread pool. Recommendation
+    requests go to the bounded scoring pool: when it is full they are turned away with a 503 and a
+    Retry-After header, and if one takes longer than SCORING_TIMEOUT it gets a 504. Every other request
+    runs on the handler pool, so user, diet and health requests stay fast while ranking is under load.
+    """
+    if scope['type'] == 'lifespan':
+        return await lifespan(receive, send)
+    if scope['type'] != 'http':
+        return
+
+    body = await read_body(receive)
+    if body is None:
+        return
+
+    pool = scoring_pool if (scope['method'], scope['path'].rstrip('/')) in SCORING_ROUTES else handler_pool
+    try:
+        status, headers, response_body = await pool.run(call_wsgi, wsgi_environ(scope, body))
+    except PoolSaturated:
+        status, headers, response_body = error_response(503, 'Server is busy, try again shortly', [(b'retry-after', b'1')])
+    except asyncio.TimeoutError:
+        status, headers, response_body = error_response(504, f'Request took longer than {pool.timeout}s')
+
+    await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+    await send({'type': 'http.response.body', 'body': response_body})
@@ -0,0 +1,217 @@
+import json
+import pickle
+import threading
+import time
+from collections import OrderedDict
+
+from recommend import get_time_tags
+
+class LocalCacheBackend:
+    """
+    In-process LRU cache whose entries also expire after a time to live.
+    """
+    def __init__(self, max_entries=1024, ttl=300) -> None:
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.counters = {}
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self.entries[key]
+                self.evictions += 1
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def counter(self, key):
+        return self.counters.get(key, 0)
+
+    def incr(self, key):
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + 1
+            return self.counters[key]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.counters.clear()
+
+    def __len__(self):
+        return len(self.entries)
+
+class RedisCacheBackend:
+    """
+    Shared cache backend so that several workers can serve each other's results. Requires the redis package.
+    """
+    def __init__(self, url, ttl=300, prefix="smartshop:recommend:") -> None:
+        import redis
+
+        self.client = redis.Redis.from_url(url)
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def get(self, key):
+        value = self.client.get(self.prefix + key)
+        return None if value is None else pickle.loads(value)
+
+    def set(self, key, value):
+        self.client.set(self.prefix + key, pickle.dumps(value), ex=self.ttl)
+
+    def counter(self, key):
+        return int(self.client.get(self.prefix + key) or 0)
+
+    def incr(self, key):
+        return self.client.incr(self.prefix + key)
+
+    def clear(self):
+        for key in self.client.scan_iter(self.prefix + "*"):
+            self.client.delete(key)
+
+class RecommendationCache:
+    """
+    Caches recommendations, ranked recipe lists and exercise responses, keyed on the user, the normalized request arguments,
+    the time bucket from get_time_tags and the model version.
+
+    Invalidating a user bumps that user's generation, which is part of every key, so their stale
+    entries are never served again and age out of the cache. When a shared backend is given it is
+    consulted on a local miss and holds the user generations, so invalidations reach every worker.
+    """
+    def __init__(self, max_entries=1024, ttl=300, shared_backend=None) -> None:
+        self.local = LocalCacheBackend(max_entries=max_entries, ttl=ttl)
+        self.shared = shared_backend
+        self.hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    @property
+    def generations(self):
+        return self.local if self.shared is None else self.shared
+
+    def key(self, kind, user_id, args, model_version):
+        normalized_args = {name: sorted(value) if isinstance(value, list) else value
+                           for name, value in sorted(args.items()) if value is not None}
+        return json.dumps([kind, user_id, self.generations.counter(f"generation:{user_id}"), normalized_args, get_time_tags(), model_version],
+                          default=str)
+
+    def get(self, key):
+        value = self.local.get(key)
+        if value is not None:
+            self.hits += 1
+            return value
+
+        if self.shared is not None:
+            value = self.shared.get(key)
+            if value is not None:
+                self.shared_hits += 1
+                self.local.set(key, value)
+                return value
+
+        self.misses += 1
+        return None
+
+    def set(self, key, value):
+        self.local.set(key, value)
+        if self.shared is not None:
+            self.shared.set(key, value)
+
+    def invalidate_user(self, user_id):
+        self.invalidations += 1
+        self.generations.incr(f"generation:{user_id}")
+
+    def clear(self):
+        self.local.clear()
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'shared_hits': self.shared_hits,
+            'misses': self.misses,
+            'evictions': self.local.evictions,
+            'invalidations': self.invalidations,
+            'entries': len(self.local),
+        }
+
+class UserProfile:
+    """
+    Immutable copy of a user's row, small enough to cache for every active user.
+    """
+    __slots__ = ('user_id', 'username', 'current_daily_calories', 'goal_daily_calories', 'name', 'age', 'height', 'weight',
+                 'gender', 'current_level_of_activity', 'goal_level_of_activity', 'weight_goal')
+
+    def __init__(self, **fields) -> None:
+        for name in self.__slots__:
+            object.__setattr__(self, name, fields.get(name))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("UserProfile is read-only")
+
+    @classmethod
+    def from_user(cls, user):
+        return cls(**{name: getattr(user, name) for name in cls.__slots__})
+
+class ProfileCache:
+    """
+    Read-through cache of user profiles keyed by username.
+
+    Writes in this process update the cached profile directly. The time to live bounds how long a
+    change made by another worker can go unseen.
+    """
+    def __init__(self, max_entries=10000, ttl=60) -> None:
+        self.entries = LocalCacheBackend(max_entries=max_entries, ttl=ttl)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, username, load):
+        """
+        Returns the cached profile for username, or calls load(username) for the user's row on a miss.
+        Returns None for an unknown user, which is not cached.
+        """
+        profile = self.entries.get(username)
+        if profile is not None:
+            self.hits += 1
+            return profile
+
+        self.misses += 1
+        user = load(username)
+        if user is None:
+            return None
+        profile = UserProfile.from_user(user)
+        self.entries.set(username, profile)
+        return profile
+
+    def update(self, user):
+        self.entries.set(user.username, UserProfile.from_user(user))
+
+    def invalidate(self, username):
+        self.entries.delete(username)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else None,
+            'evictions': self.entries.evictions,
+            'entries': len(self.entries),
+        }
@@ -1,44 +1,454 @@
+import argparse
+import logging
+import os
+import threading
+import time
+import numpy as np
 import pandas as pd
-from sqlalchemy import create_engine
-from surprise import Dataset, Reader, SVD
+from sqlalchemy import text
+from indexes import TagIndex, NutrientIndex, ExerciseIndex, EXERCISE_FILTER_COLUMNS, NUTRIENT_COLUMNS
+from snapshot import Snapshot, SNAPSHOT_DIR, read_source_csv, read_source_column
+from model_store import MODELS_DIR, FactorModel, load_current, train_svd
+from shared_data import SharedData
+from precompute import PRECOMPUTED_DIR, PrecomputedStore
+from storage import get_engine
+from metrics import LOAD_SECONDS, STAGE_SECONDS
+
+logger = logging.getLogger(__name__)
 
 data = None
 
+# Held while ratings are recorded and while a retrained DataManager replays them and is swapped in, so no rating is missed
+ratings_lock = threading.RLock()
+
+# Frame, item column and model attributes holding each kind of rating
+RATING_SOURCES = {
+    'recipe': ('user_interactions', 'id', 'recipe_colab_filter'),
+    'exercise': ('exercise_ratings', 'exercise_id', 'exercise_colab_filter'),
+}
+
+# Recipe text columns that compact mode leaves on disk until a response needs them
+RECIPE_LAZY_COLUMNS = ['tags', 'steps', 'description', 'ingredients']
+
+# Recipe columns returned when a request does not ask for specific fields
+DEFAULT_RECIPE_FIELDS = ['id', 'name', 'minutes', 'n_ingredients', 'calories', 'bayesian_avg']
+
+# Narrow dtypes compact mode stores each frame's columns as, where the values fit
+COMPACT_DTYPES = {
+    'recipes': {'id': np.int32, 'minutes': np.int32, 'n_steps': np.int16, 'n_ingredients': np.int16, 'bayesian_avg': np.float32,
+                **{column: np.float32 for column in NUTRIENT_COLUMNS}},
+    'user_interactions': {'user_id': np.int32, 'id': np.int32, 'rating': np.uint8},
+    'exercises': {'id': np.int32, 'Rating': np.float32},
+    'exercise_ratings': {'user_id': np.int32, 'exercise_id': np.int32, 'rating': np.uint8},
+}
+
 class DataManager:
-    def __init__(self) -> None:
-        self.recipes = pd.merge(pd.read_csv("Data/Recipes.csv"), pd.read_csv("Data/Recipe_Bayesian_Ratings.csv"), how='left', left_on='id', right_on='id', suffixes=(False, False))
-        self.user_interactions = pd.concat([pd.read_csv("Data/Interactions.csv"),
-                                            read_recipe_ratings_db().rename(columns={'recipe_id': 'id'}, inplace=True)], ignore_index=True)
+    """
+    Loads the recipes, exercises and ratings with their indexes and collaborative filtering models.
+
+    In compact mode ids, ratings and nutrients are stored in the narrowest dtype that holds them, and
+    the recipe text columns are not kept in memory: tags live on only as the tag index, and
+    with_lazy_columns reads the text back for the rows of a response. Reading them back needs a snapshot,
+    so without one compact mode keeps the text columns in memory.
+
+    Given a shared_dir that a loader process has published to, the DataManager attaches to the published
+    generation instead of loading, so workers share one copy of the numeric data.
+
+    Unfiltered recipe and exercise recommendations precomputed with precompute.py into precomputed_dir are
+    served by precomputed_recipes and precomputed_exercises for as long as they were computed with the current models.
+
+    progress, if given, is called with each load stage's name as it starts and with its name and duration as it ends.
+    """
+    def __init__(self, snapshot_dir=SNAPSHOT_DIR, models_dir=MODELS_DIR, compact=False, shared_dir=None, progress=None,
+                 precomputed_dir=PRECOMPUTED_DIR) -> None:
+        self.load_timings = {}
+        self.progress = progress
+        self.snapshot_dir = snapshot_dir
+        self.models_dir = models_dir
+        self.compact = compact
+        self.lazy_columns = RECIPE_LAZY_COLUMNS if compact else []
+        self.source_columns = {}
+        self.snapshot = None
+        self.shared_generation = None
+
+        shared = self.timed('shared', lambda: SharedData.open(shared_dir)) if shared_dir else None
+        if shared is not None:
+            self.attach(shared)
+        else:
+            if shared_dir:
+                logger.info("Nothing published in %s, loading the data in this process", shared_dir)
+            self.load()
+
+        self.new_ratings = {kind: {} for kind in RATING_SOURCES}
+        self.successor = None
+        self.user_rating_counts = {kind: getattr(self, frame_name)['user_id'].value_counts().to_dict()
+                                   for kind, (frame_name, _, _) in RATING_SOURCES.items()}
+        self.item_ids = {'recipe': frozenset(self.recipes['id'].tolist()), 'exercise': frozenset(self.exercises['id'].tolist())}
+        self.model_versions = {
+            'recipe': self.recipe_colab_filter.version if self.recipe_colab_filter else None,
+            'exercise': self.exercise_colab_filter.version if self.exercise_colab_filter else None,
+        }
+        self.precomputed = self.timed('precomputed', lambda: PrecomputedStore.open(precomputed_dir) if precomputed_dir else None)
+
+        logger.info("Data loaded: %s", ", ".join(f"{name} {seconds:.2f}s" for name, seconds in self.load_timings.items()))
+
+    def load(self):
+        self.snapshot = self.timed('snapshot', lambda: Snapshot.open(self.snapshot_dir) if self.snapshot_dir else None)
+        if self.snapshot is None:
+            logger.info("No up-to-date snapshot in %s, parsing CSV files", self.snapshot_dir)
+            if self.lazy_columns:
+                logger.info("Keeping the recipe text columns in memory, since there is no snapshot to read them back from")
+                self.lazy_columns = []
+
+        self.recipes = self.timed('recipes', lambda: self.load_source('recipes', skip=self.lazy_columns))
+        recipe_ratings = self.timed('recipe_ratings_db', read_recipe_ratings_db)
+        self.user_interactions = pd.concat([self.timed('interactions', lambda: self.load_source('interactions')),
+                                            recipe_ratings.rename(columns={'recipe_id': 'id'})], ignore_index=True)
+        if self.compact:
+            self.timed('compact', lambda: self.compact_frames('recipes', 'user_interactions'))
+        self.timed('recipe_indexes', self.build_recipe_indexes)
         self.recipe_colab_filter = None
-        self.recipe_colab_filter_trainset = None
-        self.setup_recipe_colab_filter()
+        self.timed('recipe_model', self.setup_recipe_colab_filter)
 
-        self.exercises = pd.read_csv("Data/Exercises.csv")
-        self.exercise_ratings = read_exercises_ratings_db()
+        self.exercises = self.timed('exercises', lambda: self.load_source('exercises'))
+        self.exercises[EXERCISE_FILTER_COLUMNS] = self.exercises[EXERCISE_FILTER_COLUMNS].astype('category')
+        self.exercise_index = self.timed('exercise_index', lambda: ExerciseIndex(self.exercises))
+        self.exercise_ratings = self.timed('exercise_ratings_db', read_exercises_ratings_db)
+        if self.compact:
+            self.compact_frames('exercises', 'exercise_ratings')
         self.exercise_colab_filter = None
-        self.exercise_colab_filter_trainset = None
+        self.timed('exercise_model', self.setup_exercise_colab_filter)
+        self.user_rating_index = self.timed('rating_indexes', lambda: {kind: build_sorted_index(getattr(self, frame_name)['user_id'])
+                                                                       for kind, (frame_name, _, _) in RATING_SOURCES.items()})
+        self.db_rating_counts = {'recipe': len(recipe_ratings), 'exercise': len(self.exercise_ratings)}
+        self.loaded_at = time.time()
+
+    def attach(self, shared):
+        """
+        Takes the frames, indexes and models from a generation published with shared_data.publish_data
+        instead of loading and indexing the data in this process.
+
+        Numeric columns and index arrays are read-only memory-mapped views shared with every other attached worker.
+        The exercise index, the per-user rating counts and the item id sets are not shared: each worker builds them
+        from the shared columns, since they are hash-based Python objects that cannot be memory-mapped, and the
+        counts change as the worker records ratings.
+        """
+        manifest = shared.manifest
+        self.shared_generation = shared.generation
+        self.snapshot_dir = manifest['snapshot_dir']
+        self.models_dir = manifest['models_dir']
+        self.compact = manifest['compact']
+        self.lazy_columns = manifest['lazy_columns']
+        self.source_columns = manifest['source_columns']
+        if self.lazy_columns:
+            self.snapshot = self.timed('snapshot', lambda: Snapshot.open(self.snapshot_dir) if self.snapshot_dir else None)
+
+        self.recipes = self.timed('recipes', lambda: shared.frame('recipes'))
+        if self.lazy_columns and self.snapshot is None:
+            logger.info("No snapshot in %s to read the recipe text columns back from, keeping them in memory", self.snapshot_dir)
+            self.recipes = self.timed('recipe_text', self.with_source_text_columns)
+            self.lazy_columns = []
+        self.user_interactions = self.timed('interactions', lambda: shared.frame('user_interactions'))
+        self.recipe_tag_index = TagIndex.from_bitmaps(len(self.recipes), dict(zip(manifest['tags'], shared.array('tag_bitmaps'))))
+        self.recipe_id_index = (shared.array('recipe_id_index_values'), shared.array('recipe_id_index_order'))
+        self.recipe_nutrient_index = NutrientIndex.from_arrays(len(self.recipes), *(
+            {column: shared.array(f'nutrient_{position}_{part}') for position, column in enumerate(manifest['nutrient_columns'])}
+            for part in ('values', 'order', 'sorted_values')))
+
+        self.exercises = self.timed('exercises', lambda: shared.frame('exercises'))
+        self.exercises[EXERCISE_FILTER_COLUMNS] = self.exercises[EXERCISE_FILTER_COLUMNS].astype('category')
+        self.exercise_index = ExerciseIndex(self.exercises)
+        self.exercise_ratings = shared.frame('exercise_ratings')
+        self.user_rating_index = {kind: (shared.array(f'{kind}_user_rating_index_values'), shared.array(f'{kind}_user_rating_index_order'))
+                                  for kind in RATING_SOURCES}
+
+        for kind, (_, _, model_attribute) in RATING_SOURCES.items():
+            version = manifest['model_versions'][kind]
+            model = FactorModel.load(os.path.join(self.models_dir, kind, version)) if version else None
+            setattr(self, model_attribute, model)
+        self.db_rating_counts = manifest['db_rating_counts']
+        self.loaded_at = manifest['loaded_at']
+
+    def with_source_text_columns(self):
+        """
+        Returns the recipes with the columns compact mode left on disk parsed back in from the CSV, in source column order.
+        """
+        columns = {column: self.recipes[column] if column in self.recipes else read_source_column('recipes', column).to_numpy()
+                   for column in self.source_columns['recipes']}
+        return pd.DataFrame(columns, index=self.recipes.index, copy=False)
+
+    def timed(self, name, load):
+        if self.progress is not None:
+            self.progress(name)
+        start = time.perf_counter()
+        result = load()
+        self.load_timings[name] = time.perf_counter() - start
+        LOAD_SECONDS.observe(self.load_timings[name], name)
+        if self.progress is not None:
+            self.progress(name, self.load_timings[name])
+        return result
+
+    def build_recipe_indexes(self):
+        self.recipe_tag_index = TagIndex(self.load_column('recipes', 'tags') if 'tags' in self.lazy_columns else self.recipes['tags'])
+        self.recipe_id_index = build_sorted_index(self.recipes['id'])
+        self.recipe_nutrient_index = NutrientIndex(self.recipes)
+
+    def load_source(self, name, skip=()):
+        if self.snapshot is not None:
+            self.source_columns[name] = [column['name'] for column in self.snapshot.manifest['frames'][name]['columns']]
+            return self.snapshot.frame(name, skip=skip)
+        frame = read_source_csv(name)
+        self.source_columns[name] = list(frame.columns)
+        return frame.drop(columns=list(skip))
+
+    def load_column(self, name, column, rows=None):
+        """
+        Reads one column of a source frame from the snapshot, or only the given positional rows of it.
+        Without a snapshot the column is parsed from its CSV file on every call and not kept.
+        """
+        if self.snapshot is not None:
+            return self.snapshot.column(name, column, rows=rows)
+        values = read_source_column(name, column).to_numpy()
+        return values if rows is None else values[rows]
+
+    def compact_frames(self, *frame_names):
+        for frame_name in frame_names:
+            setattr(self, frame_name, downcast(getattr(self, frame_name), COMPACT_DTYPES[frame_name]))
+
+    def with_lazy_columns(self, recipes_found):
+        """
+        Adds the text columns compact mode left on disk back onto a frame of recipes, in the original column order.
+        """
+        if not self.lazy_columns or recipes_found.empty:
+            return recipes_found
+
+        sorted_ids, order = self.recipe_id_index
+        rows = order[np.searchsorted(sorted_ids, recipes_found['id'].to_numpy())]
+        recipes_found = recipes_found.copy()
+        for column in self.lazy_columns:
+            recipes_found[column] = self.load_column('recipes', column, rows)
+        return recipes_found[[column for column in self.source_columns['recipes'] if column in recipes_found]]
+
+    def precomputed_recipes(self, user_id, time_tags, top_k):
+        """
+        Returns the user's unfiltered top_k recipes from the precomputed store, or None if they have to be scored
+        live: no store, a store computed with another recipe model, ratings added since load, or top_k above the stored lists.
+        """
+        store = self.precomputed
+        if store is None or store.model_versions.get('recipe') != self.model_versions['recipe'] or user_id in self.new_ratings['recipe']:
+            return None
+
+        found = store.recipes(user_id, time_tags, top_k, known_user=self.is_user_in_filter(user_id, self.recipe_colab_filter))
+        if found is None:
+            return None
+        ids, labels = found
+        sorted_ids, order = self.recipe_id_index
+        recipes_found = self.recipes.iloc[order[np.searchsorted(sorted_ids, ids)]]
+        recipes_found.index = labels
+        return recipes_found
+
+    def precomputed_exercises(self, user_id, top_k):
+        """
+        Returns the user's unfiltered top_k exercises from the precomputed store, or None if they have to be scored
+        live, for the same reasons as precomputed_recipes with the exercise model.
+        """
+        store = self.precomputed
+        if store is None or store.model_versions.get('exercise') != self.model_versions['exercise'] or user_id in self.new_ratings['exercise']:
+            return None
+
+        rows = store.exercises(user_id, top_k, known_user=self.is_user_in_filter(user_id, self.exercise_colab_filter))
+        if rows is None:
+            return None
+        return self.exercises.iloc[rows]
+
+    def recipe_fields(self):
+        """
+        Returns the names of every recipe column, including those compact mode left on disk, in source order.
+        """
+        return self.source_columns.get('recipes') or list(self.recipes.columns)
+
+    def recipe_records(self, ids, fields=DEFAULT_RECIPE_FIELDS):
+        """
+        Returns the given recipes as one dict of the requested fields per recipe, in the order of ids.
+
+        Only the requested columns are read, so text columns compact mode left on disk are only read when asked for.
+        """
+        if len(ids) == 0:
+            return []
+        with STAGE_SECONDS.time('serialize'):
+            sorted_ids, order = self.recipe_id_index
+            rows = order[np.searchsorted(sorted_ids, np.asarray(ids))]
+            columns = [self.load_column('recipes', field, rows) if field in self.lazy_columns else self.recipes[field].values[rows]
+                       for field in fields]
+            return [dict(zip(fields, values)) for values in zip(*(float32_as_float64(column).tolist() for column in columns))]
+
+    def memory_report(self):
+        """
+        Returns the bytes held by each column of the loaded frames and by each index.
+
+        Nothing else is kept in memory: text columns compact mode leaves on disk are read per request and not cached.
+        """
+        report = {}
+        for frame_name in ('recipes', 'user_interactions', 'exercises', 'exercise_ratings'):
+            usage = getattr(self, frame_name).memory_usage(deep=True)
+            report[frame_name] = {str(column): int(nbytes) for column, nbytes in usage.items()}
+        report['indexes'] = {
+            'recipe_tag_index': self.recipe_tag_index.nbytes(),
+            'recipe_nutrient_index': self.recipe_nutrient_index.nbytes(),
+            'exercise_index': self.exercise_index.nbytes(),
+            'recipe_id_index': sum(array.nbytes for array in self.recipe_id_index),
+            'user_rating_index': sum(array.nbytes for index in self.user_rating_index.values() for array in index),
+        }
+        return report
 
-    
     def setup_recipe_colab_filter(self):
-        data = Dataset.load_from_df(self.user_interactions[["user_id", "id", "rating"]], Reader(rating_scale=(0, 5)))
-        self.recipe_colab_filter_trainset = data.build_full_trainset()
-        self.recipe_colab_filter = SVD(n_factors=1, n_epochs=1, biased=True, lr_all=0.005, reg_all=0.2)
-        self.recipe_colab_filter.fit(self.recipe_colab_filter_trainset)
-    
-    def is_user_in_filter(self, ruid, trainset):
-        try:
-            trainset.knows_user(ruid)
-            return True
-        except ValueError:
-            return False
-        
+        if self.models_dir:
+            self.recipe_colab_filter = load_current('recipe', self.models_dir)
+        if self.recipe_colab_filter is None:
+            logger.info("No published recipe model in %s, training one", self.models_dir)
+            self.recipe_colab_filter = train_svd(self.user_interactions, "user_id", "id")
+
+    def setup_exercise_colab_filter(self):
+        if self.models_dir:
+            self.exercise_colab_filter = load_current('exercise', self.models_dir)
+        if self.exercise_colab_filter is None and not self.exercise_ratings.empty:
+            logger.info("No published exercise model in %s, training one", self.models_dir)
+            self.exercise_colab_filter = train_svd(self.exercise_ratings, "user_id", "exercise_id")
+
+    def is_user_in_filter(self, ruid, colab_filter):
+        return colab_filter is not None and colab_filter.knows_user(ruid)
+
+    def user_ratings(self, kind, user_id):
+        """
+        Returns the user's 'recipe' or 'exercise' ratings as a dict of item id to rating, including ratings added since load.
+        """
+        frame_name, item_column, _ = RATING_SOURCES[kind]
+        frame = getattr(self, frame_name)
+        sorted_user_ids, order = self.user_rating_index[kind]
+        rows = order[np.searchsorted(sorted_user_ids, user_id, side='left'):np.searchsorted(sorted_user_ids, user_id, side='right')]
+        ratings = dict(zip(frame[item_column].values[rows].tolist(), frame['rating'].values[rows].tolist()))
+        ratings.update(self.new_ratings[kind].get(user_id, {}))
+        return ratings
+
+    def user_rating_count(self, kind, user_id):
+        return self.user_rating_counts[kind].get(user_id, 0)
+
+    def has_item(self, kind, item_id):
+        return item_id in self.item_ids[kind]
+
+    def record_rating(self, kind, user_id, item_id, rating):
+        if item_id not in self.user_ratings(kind, user_id):
+            self.user_rating_counts[kind][user_id] = self.user_rating_counts[kind].get(user_id, 0) + 1
+        self.new_ratings[kind].setdefault(user_id, {})[item_id] = rating
+
+    def add_rating(self, kind, user_id, item_id, rating):
+        """
+        Records a rating written since load and folds the user's ratings into their factors, so it affects
+        recommendations without retraining. Returns whether the user's factors were updated.
+        """
+        return self.add_ratings(kind, user_id, {item_id: rating})
+
+    def add_ratings(self, kind, user_id, ratings):
+        """
+        Records several ratings of one user, given as a dict of item id to rating, and folds them into the
+        user's factors in a single pass. Returns whether the user's factors were updated.
+
+        Ratings recorded after this DataManager was swapped out are passed on to the one that replaced it.
+        """
+        with ratings_lock:
+            for item_id, rating in ratings.items():
+                self.record_rating(kind, user_id, item_id, rating)
+            if self.successor is not None:
+                self.successor.add_ratings(kind, user_id, ratings)
+            colab_filter = getattr(self, RATING_SOURCES[kind][2])
+            if colab_filter is None:
+                return False
+            ratings = self.user_ratings(kind, user_id)
+            return colab_filter.fold_in_user(user_id, list(ratings.keys()), list(ratings.values()))
+
+    def replay_ratings(self, previous):
+        """
+        Carries over the ratings another DataManager recorded since its load, folding each user in once.
+
+        Call with ratings_lock held and make this DataManager previous.successor before releasing it, so
+        ratings written to previous in the meantime are not lost.
+        """
+        for kind, users in previous.new_ratings.items():
+            colab_filter = getattr(self, RATING_SOURCES[kind][2])
+            for user_id, ratings in list(users.items()):
+                for item_id, rating in list(ratings.items()):
+                    self.record_rating(kind, user_id, item_id, rating)
+                if colab_filter is not None:
+                    user_ratings = self.user_ratings(kind, user_id)
+                    colab_filter.fold_in_user(user_id, list(user_ratings.keys()), list(user_ratings.values()))
+
+
+def float32_as_float64(values):
+    """
+    Widens a float32 array, as compact mode stores columns, through each value's shortest repr, so 407.2
+    stays 407.2 in responses instead of becoming 407.20001220703125. Other arrays are returned as they are.
+    """
+    if values.dtype == np.float32:
+        return values.astype(str).astype(np.float64)
+    return values
+
+def response_frame(frame):
+    """
+    Returns frame with its float32 columns widened by float32_as_float64, ready for to_dict.
+    """
+    return frame.assign(**{column: float32_as_float64(frame[column].to_numpy()) for column in frame.columns if frame[column].dtype == np.float32})
+
+def downcast(frame, dtypes):
+    """
+    Casts the columns of frame to the given narrower dtypes, leaving a column as it is if its values do not fit.
+    """
+    for column, dtype in dtypes.items():
+        if column not in frame:
+            continue
+        values = frame[column]
+        if np.issubdtype(dtype, np.integer) and len(values):
+            limits = np.iinfo(dtype)
+            if values.isna().any() or values.min() < limits.min or values.max() > limits.max:
+                continue
+        frame[column] = values.astype(dtype)
+    return frame
+
+def build_sorted_index(values):
+    """
+    Sorts rows by a column, such as the user of each rating, so a value's rows can be found with a binary search.
+    """
+    order = np.argsort(values.to_numpy(), kind='stable')
+    return values.to_numpy()[order], order
 
 def read_recipe_ratings_db():
-    engine = create_engine('sqlite:///instance/recipe_ratings.db')
-    df = pd.read_sql_table('recipe_ratings', con=engine)
+    with get_engine().connect() as connection:
+        df = pd.read_sql_query(text('SELECT user_id, recipe_id, rating FROM recipe_ratings'), con=connection,
+                               dtype={'user_id': 'int64', 'recipe_id': 'int64', 'rating': 'int64'})
     return df
 
 def read_exercises_ratings_db():
-    engine = create_engine('sqlite:///instance/exercise_ratings.db')
-    df = pd.read_sql_table('exercise_ratings', con=engine)
+    with get_engine().connect() as connection:
+        df = pd.read_sql_query(text('SELECT user_id, exercise_id, rating FROM exercise_ratings'), con=connection,
+                               dtype={'user_id': 'int64', 'exercise_id': 'int64', 'rating': 'int64'})
     return df
+
+def count_db_ratings():
+    counts = {}
+    with get_engine().connect() as connection:
+        for kind, table in (('recipe', 'recipe_ratings'), ('exercise', 'exercise_ratings')):
+            counts[kind] = connection.execute(text(f'SELECT COUNT(*) FROM {table}')).scalar()
+    return counts
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Load the data and report the memory held by each column and index")
+    parser.add_argument('--compact', action='store_true', help="Load in compact mode")
+    args = parser.parse_args()
+
+    manager = DataManager(compact=args.compact)
+    total = 0
+    for name, usage in manager.memory_report().items():
+        print(f"{name}: {sum(usage.values()) / 2 ** 20:.1f} MiB")
+        for column, nbytes in usage.items():
+            print(f"  {column}: {nbytes / 2 ** 20:.2f} MiB")
+        total += sum(usage.values())
+    print(f"Total: {total / 2 ** 20:.1f} MiB")
@@ -0,0 +1,218 @@
+import ast
+import itertools
+from collections import defaultdict
+
+import numpy as np
+import pandas as pd
+
+TAG_MATCH_EXACT = "exact"
+TAG_MATCH_SUBSTRING = "substring"
+
+EXERCISE_FILTER_COLUMNS = ['Type', 'BodyPart', 'Equipment', 'Level']
+
+NUTRIENT_COLUMNS = ['calories', 'total fat (PDV)', 'saturated fat (PDV)', 'sugar (PDV)', 'sodium (PDV)', 'protein (PDV)', 'carbohydrates (PDV)']
+
+def parse_tags(tag_list):
+    """
+    Parses a recipe's tags column value (a stringified Python list) into a list of lowercase tags.
+    """
+    if not isinstance(tag_list, str):
+        return []
+    try:
+        tags = ast.literal_eval(tag_list)
+    except (ValueError, SyntaxError):
+        return []
+    return [tag.lower() for tag in tags if isinstance(tag, str)]
+
+class TagIndex:
+    """
+    Inverted index from tag to a packed bitmap of the recipe rows carrying that tag.
+
+    Rows are positional, so a mask returned by the index lines up with the frame it was built from.
+    """
+    def __init__(self, tags_column) -> None:
+        self.size = len(tags_column)
+
+        tag_rows = defaultdict(list)
+        for row, tag_list in enumerate(tags_column):
+            for tag in parse_tags(tag_list):
+                tag_rows[tag].append(row)
+
+        self.bitmaps = {}
+        for tag, rows in tag_rows.items():
+            row_mask = np.zeros(self.size, dtype=bool)
+            row_mask[rows] = True
+            self.bitmaps[tag] = np.packbits(row_mask)
+
+        self._empty = np.zeros((self.size + 7) // 8, dtype=np.uint8)
+        self._full = np.packbits(np.ones(self.size, dtype=bool))
+
+    @classmethod
+    def from_bitmaps(cls, size, bitmaps):
+        """
+        Builds the index from already packed bitmaps, such as read-only views attached from a shared data store.
+        """
+        index = cls.__new__(cls)
+        index.size = size
+        index.bitmaps = bitmaps
+        index._empty = np.zeros((size + 7) // 8, dtype=np.uint8)
+        index._full = np.packbits(np.ones(size, dtype=bool))
+        return index
+
+    def nbytes(self):
+        return sum(bitmap.nbytes for bitmap in self.bitmaps.values())
+
+    def bitmap(self, tag, match=TAG_MATCH_EXACT):
+        tag = tag.lower()
+        match match:
+            case "exact":
+                return self.bitmaps.get(tag, self._empty)
+            case "substring":
+                bitmap = self._empty
+                for indexed_tag, indexed_bitmap in self.bitmaps.items():
+                    if tag in indexed_tag:
+                        bitmap = bitmap | indexed_bitmap
+                return bitmap
+        raise ValueError(f"Unknown tag match mode: {match}")
+
+    def mask(self, tags, match=TAG_MATCH_EXACT):
+        """
+        Returns a boolean row mask of the recipes that carry every tag in tags.
+
+        Args:
+            tags (list): Tags that must be on the recipe. Non-string entries are ignored.
+            match (str): 'exact' to match whole tags, 'substring' to match any tag containing the given text.
+
+        Returns:
+            np.ndarray: Boolean mask with one entry per recipe row.
+        """
+        bitmap = self._full
+        for tag in tags:
+            if type(tag) != str:
+                continue
+            bitmap = bitmap & self.bitmap(tag, match)
+        return np.unpackbits(bitmap, count=self.size).astype(bool)
+
+class NutrientIndex:
+    """
+    Columnar index over the recipe nutrient columns for range filtering.
+
+    Each column is kept as a contiguous float32 array alongside its sorted permutation, so the most
+    selective range can be cut with searchsorted and the remaining ranges are only checked on those rows.
+    """
+    def __init__(self, recipes, columns=NUTRIENT_COLUMNS) -> None:
+        self.size = len(recipes)
+        self.values = {}
+        self.order = {}
+        self.sorted_values = {}
+        for column in columns:
+            values = np.ascontiguousarray(recipes[column].to_numpy(dtype=np.float32))
+            order = np.argsort(values, kind='stable').astype(np.int32 if self.size < 2 ** 31 else np.int64)
+            self.values[column] = values
+            self.order[column] = order
+            self.sorted_values[column] = values[order]
+
+    @classmethod
+    def from_arrays(cls, size, values, order, sorted_values):
+        """
+        Builds the index from already computed per-column arrays, such as read-only views attached from a shared data store.
+        """
+        index = cls.__new__(cls)
+        index.size = size
+        index.values = values
+        index.order = order
+        index.sorted_values = sorted_values
+        return index
+
+    def nbytes(self):
+        return sum(array.nbytes for arrays in (self.values, self.order, self.sorted_values) for array in arrays.values())
+
+    def mask(self, limits):
+        """
+        Returns a boolean row mask of the recipes whose nutrients fall within the given inclusive ranges.
+
+        Args:
+            limits (dict): Maps a nutrient column to its (low, high) limits, as returned by parse_pdv.
+
+        Returns:
+            np.ndarray: Boolean mask with one entry per recipe row.
+        """
+        if not limits:
+            return np.ones(self.size, dtype=bool)
+
+        # Compared in float32 like the values, so a limit that float32 rounds up to a value still matches it
+        limits = {column: (np.float32(low), np.float32(high)) for column, (low, high) in limits.items()}
+        ranges = {}
+        for column, (low, high) in limits.items():
+            sorted_values = self.sorted_values[column]
+            ranges[column] = (np.searchsorted(sorted_values, low, side='left'),
+                              np.searchsorted(sorted_values, high, side='right'))
+
+        most_selective = min(ranges, key=lambda column: ranges[column][1] - ranges[column][0])
+        start, stop = ranges[most_selective]
+        rows = self.order[most_selective][start:stop]
+
+        for column, (low, high) in limits.items():
+            if column == most_selective or len(rows) == 0:
+                continue
+            start, stop = ranges[column]
+            if start == 0 and stop == self.size:
+                continue
+            values = self.values[column][rows]
+            rows = rows[(low <= values) & (values <= high)]
+
+        row_mask = np.zeros(self.size, dtype=bool)
+        row_mask[rows] = True
+        return row_mask
+
+class ExerciseIndex:
+    """
+    Lookup from a (type, body part, equipment, level) filter to the matching exercise rows.
+
+    The four filter columns are encoded as categorical codes, and every combination of filtered and
+    unfiltered columns is precomputed, so a filter is a dictionary hit returning rows already sorted by Rating.
+    """
+    def __init__(self, exercises) -> None:
+        self.size = len(exercises)
+        self.categories = {}
+        codes = []
+        for column in EXERCISE_FILTER_COLUMNS:
+            categorical = pd.Categorical(exercises[column])
+            self.categories[column] = {value: code for code, value in enumerate(categorical.categories)}
+            codes.append(categorical.codes)
+
+        ranked_rows = np.argsort(-exercises['Rating'].to_numpy(dtype=float), kind='stable')
+        ranked_codes = np.stack(codes, axis=1)[ranked_rows]
+
+        rows_by_key = defaultdict(list)
+        for row, row_codes in zip(ranked_rows, ranked_codes.tolist()):
+            for filtered in itertools.product((False, True), repeat=len(EXERCISE_FILTER_COLUMNS)):
+                # A missing value (code -1) can never match a filter on its column, but matches when that column is not filtered
+                if any(is_filtered and code == -1 for code, is_filtered in zip(row_codes, filtered)):
+                    continue
+                rows_by_key[tuple(code if is_filtered else -1 for code, is_filtered in zip(row_codes, filtered))].append(row)
+
+        self.lookup = {key: np.array(rows, dtype=np.intp) for key, rows in rows_by_key.items()}
+        self._empty = np.array([], dtype=np.intp)
+
+    def nbytes(self):
+        return sum(rows.nbytes for rows in self.lookup.values())
+
+    def values(self, column):
+        return list(self.categories[column])
+
+    def rows(self, type=None, body_part=None, equipment=None, level=None):
+        """
+        Returns the positional rows of the exercises matching every given filter, sorted by descending Rating.
+
+        Filters left as None match any value, including a missing one.
+        """
+        key = []
+        for column, value in zip(EXERCISE_FILTER_COLUMNS, (type, body_part, equipment, level)):
+            if value is None:
+                key.append(-1)
+            elif value in self.categories[column]:
+                key.append(self.categories[column][value])
+            else:
+                return self._empty
+        return self.lookup.get(tuple(key), self._empty)
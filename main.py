@@ -1,28 +1,93 @@
-from flask import Flask, abort
+from flask import Flask, Response, abort, g, make_response, request
 from flask_restful import Api, Resource, reqparse
+from flask_restful.representations.json import output_json as restful_output_json
 from flask_sqlalchemy import SQLAlchemy
 from flask_cors import CORS
-from recommend import getRecipesWithConfiguration, getExerciseWithConfiguration, get_lifestyle_score
+from recommend import getRecipesWithConfiguration, getRecipesForUsers, getExerciseWithConfiguration, get_lifestyle_score, get_time_tags
 import data_management
+from cache import RecommendationCache, RedisCacheBackend, ProfileCache
+from retraining import RetrainScheduler
+from preload import Preloader
+from write_buffer import RatingWriteBuffer
+from precompute import PRECOMPUTED_TOP_N
+from indexes import TAG_MATCH_EXACT, TAG_MATCH_SUBSTRING
+import metrics
+import atexit
+import base64
+import json
+import os
+import time
 import pandas as pd
-from sqlalchemy import create_engine
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.exc import IntegrityError
+import storage
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 app = Flask(__name__)
 api = Api(app)
 CORS(app)
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///default.db'
-app.config['SQLALCHEMY_BINDS'] = {
-    'users': 'sqlite:///user_database.db',
-    'recipe_ratings': 'sqlite:///recipe_ratings.db',
-    'exercise_ratings': 'sqlite:///exercise_ratings.db',
-}
+
+@api.representation('application/json')
+def output_json(data, code, headers=None):
+    """
+    Encodes responses with orjson when it is installed, falling back to flask-restful's encoder.
+    """
+    if orjson is None:
+        return restful_output_json(data, code, headers)
+    resp = make_response(orjson.dumps(data, option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS), code)
+    resp.headers.extend(headers or {})
+    return resp
+app.config['SQLALCHEMY_DATABASE_URI'] = storage.database_url()
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = storage.ENGINE_OPTIONS
+app.config['RECOMMENDATION_CACHE_SIZE'] = int(os.environ.get('RECOMMENDATION_CACHE_SIZE', 1024))
+app.config['RECOMMENDATION_CACHE_TTL'] = int(os.environ.get('RECOMMENDATION_CACHE_TTL', 300))
+app.config['RECOMMENDATION_CACHE_REDIS_URL'] = os.environ.get('RECOMMENDATION_CACHE_REDIS_URL')
+app.config['PROFILE_CACHE_SIZE'] = int(os.environ.get('PROFILE_CACHE_SIZE', 10000))
+app.config['PROFILE_CACHE_TTL'] = int(os.environ.get('PROFILE_CACHE_TTL', 60))
+app.config['DATA_COMPACT'] = os.environ.get('DATA_COMPACT', '').lower() in ('1', 'true', 'yes')
+app.config['SHARED_DATA_DIR'] = os.environ.get('SHARED_DATA_DIR')
+app.config['RATING_WRITE_BEHIND'] = os.environ.get('RATING_WRITE_BEHIND', '').lower() in ('1', 'true', 'yes')
+app.config['RATING_FLUSH_INTERVAL'] = float(os.environ.get('RATING_FLUSH_INTERVAL', 1.0))
+app.config['RATING_FLUSH_MAX_PENDING'] = int(os.environ.get('RATING_FLUSH_MAX_PENDING', 500))
+app.config['RETRAIN_THRESHOLD'] = int(os.environ.get('RETRAIN_THRESHOLD', 1000))
+app.config['RETRAIN_INTERVAL'] = int(os.environ.get('RETRAIN_INTERVAL', 24 * 60 * 60))
+app.config['RETRAIN_POLL_INTERVAL'] = int(os.environ.get('RETRAIN_POLL_INTERVAL', 60))
+app.config['SCORING_WORKERS'] = int(os.environ.get('SCORING_WORKERS', os.cpu_count() or 4))
+app.config['SCORING_MAX_PENDING'] = int(os.environ.get('SCORING_MAX_PENDING', 4 * (os.cpu_count() or 4)))
+app.config['SCORING_TIMEOUT'] = float(os.environ.get('SCORING_TIMEOUT', 10.0))
+app.config['HANDLER_WORKERS'] = int(os.environ.get('HANDLER_WORKERS', 32))
+app.config['PROFILER_ENABLED'] = os.environ.get('PROFILER_ENABLED', '').lower() in ('1', 'true', 'yes')
+app.config['PROFILER_SAMPLE_RATE'] = float(os.environ.get('PROFILER_SAMPLE_RATE', 1.0))
+app.config['PROFILER_DIR'] = os.environ.get('PROFILER_DIR', "instance/profiles")
 db = SQLAlchemy(app)
 
+recommendation_cache = RecommendationCache(
+    max_entries=app.config['RECOMMENDATION_CACHE_SIZE'], ttl=app.config['RECOMMENDATION_CACHE_TTL'],
+    shared_backend=RedisCacheBackend(app.config['RECOMMENDATION_CACHE_REDIS_URL'], ttl=app.config['RECOMMENDATION_CACHE_TTL'])
+                   if app.config['RECOMMENDATION_CACHE_REDIS_URL'] else None)
+
+profile_cache = ProfileCache(max_entries=app.config['PROFILE_CACHE_SIZE'], ttl=app.config['PROFILE_CACHE_TTL'])
+
+retrain_scheduler = RetrainScheduler(threshold=app.config['RETRAIN_THRESHOLD'], interval=app.config['RETRAIN_INTERVAL'],
+                                     poll_interval=app.config['RETRAIN_POLL_INTERVAL'], shared_dir=app.config['SHARED_DATA_DIR'])
+
+preloader = Preloader(lambda progress: data_management.DataManager(compact=app.config['DATA_COMPACT'], shared_dir=app.config['SHARED_DATA_DIR'],
+                                                                   progress=progress))
+
+def loaded_data():
+    data = data_management.data
+    if data is None:
+        abort(503, {'error': 'Data is still loading'})
+    return data
+
 class DBUsers(db.Model):
-    __bind_key__ = 'users'
     __tablename__ = 'users'
     user_id = db.Column(db.Integer, primary_key=True, nullable=False)
-    username = db.Column(db.String(128), nullable=False)
+    username = db.Column(db.String(128), nullable=False, unique=True, index=True)
     current_daily_calories = db.Column(db.Integer)
     goal_daily_calories = db.Column(db.Integer)
     name = db.Column(db.String(256))
@@ -41,20 +106,18 @@ class DBUsers(db.Model):
                 Goal Level of Activity = {self.goal_level_of_activity}, Weight Goal = {self.weight_goal})"""
 
 class DBRecipeRatings(db.Model):
-    __bind_key__ = 'recipe_ratings'
     __tablename__ = 'recipe_ratings'
     user_id = db.Column(db.Integer, primary_key=True, nullable=False)
-    recipe_id = db.Column(db.Integer, nullable=False)
+    recipe_id = db.Column(db.Integer, primary_key=True, nullable=False)
     rating = db.Column(db.Integer, nullable=False)
 
     def __repr__(self):
         return f"RecipeRating(User ID = {self.user_id}, RecipeID = {self.recipe_id}, Rating = {self.rating})"
 
 class DBExerciseRatings(db.Model):
-    __bind_key__ = 'exercise_ratings'
     __tablename__ = 'exercise_ratings'
     user_id = db.Column(db.Integer, primary_key=True, nullable=False)
-    exercise_id = db.Column(db.Integer, nullable=False)
+    exercise_id = db.Column(db.Integer, primary_key=True, nullable=False)
     rating = db.Column(db.Integer, nullable=False)
 
     def __repr__(self):
@@ -101,6 +164,13 @@ user_put_args.add_argument('weight_goal', type=str, help="Weight goal: 'lose', '
 
 current_max_id = None
 
+def get_profile(username):
+    return profile_cache.get(username, load_profile)
+
+def load_profile(username):
+    with metrics.STAGE_SECONDS.time('user_lookup'):
+        return DBUsers.query.filter_by(username=username).first()
+
 class User(Resource):
     def post(self):
         args = user_post_args.parse_args()
@@ -176,15 +246,20 @@ class User(Resource):
         new_user = DBUsers(**new_user_data)
 
         db.session.add(new_user)
-        db.session.commit()
+        try:
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+            abort(403, {'error': 'User already exists'})
         current_max_id += 1
+        profile_cache.update(new_user)
         
         return {"data": {"username": username}}, 201
 
     def get(self):
         args = user_get_args.parse_args()
         username = args['username']
-        user = DBUsers.query.filter_by(username=username).first()
+        user = get_profile(username)
 
         if not user:
             abort(404, {'error': 'User not found'})
@@ -266,6 +341,7 @@ class User(Resource):
             user.weight_goal = args['weight_goal']
 
         db.session.commit()
+        profile_cache.update(user)
         
         return {'message': 'User information updated successfully'}, 200
 
@@ -279,40 +355,161 @@ recipe_get_args.add_argument("sugar", type=str, help="Sugar (PDV): 'high' or 'mi
 recipe_get_args.add_argument("sodium", type=str, help="Sodium (PDV): 'high' or 'mid' or 'low'", location='args')
 recipe_get_args.add_argument("protein", type=str, help="Protein (PDV): 'high' or 'mid' or 'low'", location='args')
 recipe_get_args.add_argument("carbs", type=str, help="Carbohydrates (PDV): 'high' or 'mid' or 'low'", location='args')
-recipe_get_args.add_argument("tags", type=list, help="Tags that must be on the food", location='args')
+recipe_get_args.add_argument("tags", type=str, action='append', help="Tags that must be on the food", location='args')
+recipe_get_args.add_argument("tag_match", type=str, choices=('exact', 'substring'), default='exact', help="Match tags 'exact'ly or as a 'substring'", location='args')
+recipe_get_args.add_argument("top_k", type=int, default=5, help="Number of recipes to return", location='args')
+recipe_get_args.add_argument("fields", type=str, action='append', help="Recipe fields to return, comma separated, or 'all'", location='args')
+recipe_get_args.add_argument("cursor", type=str, help="next_cursor of the previous page", location='args')
 
 recipe_put_args = reqparse.RequestParser()
 recipe_put_args.add_argument("username", type=str, help="Enter Username", location='args', required=True)
 recipe_put_args.add_argument("recipe_id", type=int, help="Enter the id of the recipe", location='args', required=True)
 recipe_put_args.add_argument("rating", type=int, help="Enter the rating, integer from 0 to 5 inclusive", location='args', required=True)
 
+# Recipe filters a ranked list depends on, carried in its cursors
+PDV_FILTER_ARGS = ('fat', 'sat_fat', 'sugar', 'sodium', 'protein', 'carbs')
+RECIPE_FILTER_ARGS = ('calories', *PDV_FILTER_ARGS, 'tags', 'tag_match')
+
+# Levels parse_pdv limits a nutrient to, any other value leaves the nutrient unfiltered
+PDV_LEVELS = ('high', 'med', 'low')
+
+# Number of recipes ranked and cached per list, which cursors page through. Matches the precomputed
+# lists, so unfiltered requests can be served from them
+RANKED_LIST_SIZE = PRECOMPUTED_TOP_N
+
+def parse_fields(data, fields):
+    """
+    Returns the recipe fields a request asked for, DEFAULT_RECIPE_FIELDS if it did not ask, or every field for 'all'.
+    """
+    fields = [field.strip() for value in fields or [] for field in value.split(',') if field.strip()]
+    if not fields:
+        return data_management.DEFAULT_RECIPE_FIELDS
+    if fields == ['all']:
+        return data.recipe_fields()
+    unknown = [field for field in fields if field not in data.recipe_fields()]
+    if unknown:
+        abort(400, {'error': f"Unknown fields: {', '.join(unknown)}"})
+    return list(dict.fromkeys(fields))
+
+def encode_cursor(state):
+    return base64.urlsafe_b64encode(json.dumps(state, separators=(',', ':')).encode()).decode().rstrip('=')
+
+def recipe_filters(args):
+    """
+    Returns the recipe filters of a request, with PDV values that do not limit anything normalized to None.
+    """
+    filters = {name: args[name] for name in RECIPE_FILTER_ARGS}
+    for name in PDV_FILTER_ARGS:
+        if filters[name] not in PDV_LEVELS:
+            filters[name] = None
+    return filters
+
+def decode_cursor(cursor):
+    """
+    Returns the state encoded in a cursor, aborting with a 400 if it is not one this server issued.
+    """
+    try:
+        state = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        filters = state['filters']
+        valid = ('model_version' in state and isinstance(state['offset'], int) and state['offset'] >= 0 and isinstance(state['top_k'], int) and state['top_k'] >= 1
+                 and set(filters) == set(RECIPE_FILTER_ARGS)
+                 and (filters['calories'] is None or type(filters['calories']) is int)
+                 and (filters['tags'] is None or isinstance(filters['tags'], list) and all(isinstance(tag, str) for tag in filters['tags']))
+                 and filters['tag_match'] in (TAG_MATCH_EXACT, TAG_MATCH_SUBSTRING)
+                 and all(filters[name] is None or filters[name] in PDV_LEVELS for name in PDV_FILTER_ARGS))
+    except (ValueError, TypeError, KeyError):
+        valid = False
+    if not valid:
+        abort(400, {'error': 'Invalid cursor'})
+    return state
+
+# Daily calorie goal the nutrient limits are scaled to for users who have not set one
+DEFAULT_DAILY_CALORIES = 2000
+
+def daily_calories(user):
+    return user.goal_daily_calories or DEFAULT_DAILY_CALORIES
+
+def recipe_list_key(user, filters, length, model_version):
+    return recommendation_cache.key('recipe', user.user_id, dict(filters, daily=daily_calories(user), length=length), model_version)
+
+def ranked_recipe_ids(data, user, filters, length):
+    """
+    Returns the ids of the user's top length recipes for the filters, ranked once and then served from the recommendation cache.
+    """
+    cache_key = recipe_list_key(user, filters, length, data.model_versions['recipe'])
+    ids = recommendation_cache.get(cache_key)
+    if ids is not None:
+        return ids
+
+    # Unfiltered requests are what precompute.py ranks ahead of time for every user
+    unfiltered = filters['calories'] is None and not filters['tags'] and not any(filters[name] for name in PDV_FILTER_ARGS)
+    recipes_found = data.precomputed_recipes(user.user_id, get_time_tags(), length) if unfiltered else None
+    if recipes_found is None and data.is_user_in_filter(user.user_id, data.recipe_colab_filter):
+        recipes_found = getRecipesWithConfiguration(data.recipes, user.user_id, data.user_rating_count('recipe', user.user_id),
+                                       colab_filter=data.recipe_colab_filter,
+                                       calories=filters['calories'], daily=daily_calories(user),
+                                       fat=filters['fat'], sat_fat=filters['sat_fat'],
+                                       sugar=filters['sugar'], sodium=filters['sodium'], protein=filters['protein'],
+                                       carbs=filters['carbs'], tags=filters['tags'] or [],
+                                       tag_index=data.recipe_tag_index, tag_match=filters['tag_match'],
+                                       nutrient_index=data.recipe_nutrient_index, top_k=length)
+    elif recipes_found is None:
+        recipes_found = getRecipesWithConfiguration(data.recipes, user.user_id, 0, colab_filter=None,
+                            calories=filters['calories'], daily=daily_calories(user),
+                            fat=filters['fat'], sat_fat=filters['sat_fat'],
+                            sugar=filters['sugar'], sodium=filters['sodium'], protein=filters['protein'],
+                            carbs=filters['carbs'], tags=filters['tags'] or [],
+                            tag_index=data.recipe_tag_index, tag_match=filters['tag_match'],
+                            nutrient_index=data.recipe_nutrient_index, top_k=length)
+
+    ids = recipes_found['id'].tolist()
+    recommendation_cache.set(cache_key, ids)
+    return ids
+
+def recipe_page(data, ids, fields, state):
+    """
+    Returns the page of a ranked list that state points at, with a cursor to the next page if there is one.
+    """
+    offset, top_k = state['offset'], state['top_k']
+    next_offset = offset + top_k
+    return {
+        'recipes': data.recipe_records(ids[offset:next_offset], fields),
+        'next_cursor': encode_cursor(dict(state, offset=next_offset)) if next_offset < len(ids) else None,
+    }
+
 class Recipe(Resource):
     def get(self):
+        """
+        Recommends recipes to a user, one page of top_k at a time.
+
+        The first RANKED_LIST_SIZE recipes, or top_k if more, are ranked once and cached. Passing the
+        returned next_cursor pages through that list with the filters and top_k of the first request.
+        """
         args = recipe_get_args.parse_args()
-        user = DBUsers.query.filter_by(username=args['username']).first()
+        data = loaded_data()
+        user = get_profile(args['username'])
 
         if not user:
             abort(404, {'error': 'User not found'})
 
-        if data_management.data.is_user_in_filter(user.user_id, data_management.data.recipe_colab_filter_trainset):
-            resp = getRecipesWithConfiguration(data_management.data.recipes, user.user_id, (data_management.data.user_interactions['user_id'] == user.user_id).sum(),
-                                           colab_filter=data_management.data.recipe_colab_filter,
-                                           calories=args['calories'], daily=user.goal_daily_calories,
-                                           fat=args['fat'], sat_fat=args['sat_fat'],
-                                           sugar=args['sugar'], sodium=args['sodium'], protein=args['protein'],
-                                           carbs=args['carbs'], tags=args['tags'])
+        model_version = data.model_versions['recipe']
+        if args['cursor'] is not None:
+            state = decode_cursor(args['cursor'])
+            if state['model_version'] != model_version:
+                abort(410, {'error': 'The recommendations changed since this cursor was issued, request the first page again'})
         else:
-            resp = getRecipesWithConfiguration(data_management.data.recipes, user.user_id, 0, colab_filter=None,
-                                calories=args['calories'], daily=user.goal_daily_calories,
-                                fat=args['fat'], sat_fat=args['sat fat'],
-                                sugar=args['sugar'], sodium=args['sodium'], protein=args['protein'],
-                                carbs=args['carbs'], tags=args['tags'])
-    
-        return resp[:5].to_dict()
+            if args['top_k'] < 1:
+                abort(400, {'error': 'top_k must be a positive integer'})
+            state = {'filters': recipe_filters(args), 'top_k': args['top_k'], 'offset': 0, 'model_version': model_version}
+
+        fields = parse_fields(data, args['fields'])
+        ids = ranked_recipe_ids(data, user, state['filters'], max(RANKED_LIST_SIZE, state['top_k']))
+        return recipe_page(data, ids, fields, state), 200, {'X-Model-Version': str(model_version)}
     
     def put(self):
         args = recipe_put_args.parse_args()
-        user = DBUsers.query.filter_by(username=args['username']).first()
+        data = loaded_data()
+        user = get_profile(args['username'])
 
         if not user:
             abort(404, {'error': 'User not found'})        
@@ -320,19 +517,98 @@ class Recipe(Resource):
         if not args['rating'] in [0, 1, 2, 3, 4, 5]:
             abort(400, {'error': 'Rating not integer in range [0, 5]'})
         
-        if not args['recipe_id'] in data_management.data.recipes['id'].values:
+        if not data.has_item('recipe', args['recipe_id']):
             abort(404, {'error': 'Invalid recipe_id'})
 
-        user_rating = DBRecipeRatings.query.filter_by(user_id=user.user_id, recipe_id=args['recipe_id']).first()
-        if user_rating is None:
-            new_rating = DBRecipeRatings(user_id=user.user_id, recipe_id=args['recipe_id'], rating=args['rating'])
-            db.session.add(new_rating)
-            db.session.commit()
+        if rating_buffer is not None:
+            rating_buffer.add('recipe', user.user_id, args['recipe_id'], args['rating'])
         else:
-            user_rating.rating = args['rating']
-            db.session.commit()
+            user_rating = db.session.get(DBRecipeRatings, (user.user_id, args['recipe_id']))
+            if user_rating is None:
+                new_rating = DBRecipeRatings(user_id=user.user_id, recipe_id=args['recipe_id'], rating=args['rating'])
+                db.session.add(new_rating)
+                db.session.commit()
+            else:
+                user_rating.rating = args['rating']
+                db.session.commit()
+
+        data.add_rating('recipe', user.user_id, args['recipe_id'], args['rating'])
+        recommendation_cache.invalidate_user(user.user_id)
         
-        return {"data": {"username": args['username']}}, 201
+        return {"data": {"username": args['username']}}, 202 if rating_buffer is not None else 201
+
+recipe_batch_args = reqparse.RequestParser()
+recipe_batch_args.add_argument("usernames", type=str, action='append', help="Usernames to recommend recipes to", location='json', required=True)
+recipe_batch_args.add_argument("calories", type=int, help="Number of calories of the food", location='json')
+recipe_batch_args.add_argument("fat", type=str, help="Total Fat (PDV): 'high' or 'mid' or 'low'", location='json')
+recipe_batch_args.add_argument("sat_fat", type=str, help="Saturated Fat (PDV): 'high' or 'mid' or 'low'", location='json')
+recipe_batch_args.add_argument("sugar", type=str, help="Sugar (PDV): 'high' or 'mid' or 'low'", location='json')
+recipe_batch_args.add_argument("sodium", type=str, help="Sodium (PDV): 'high' or 'mid' or 'low'", location='json')
+recipe_batch_args.add_argument("protein", type=str, help="Protein (PDV): 'high' or 'mid' or 'low'", location='json')
+recipe_batch_args.add_argument("carbs", type=str, help="Carbohydrates (PDV): 'high' or 'mid' or 'low'", location='json')
+recipe_batch_args.add_argument("tags", type=str, action='append', help="Tags that must be on the food", location='json')
+recipe_batch_args.add_argument("tag_match", type=str, choices=('exact', 'substring'), default='exact', help="Match tags 'exact'ly or as a 'substring'", location='json')
+recipe_batch_args.add_argument("top_k", type=int, default=5, help="Number of recipes to return per user", location='json')
+recipe_batch_args.add_argument("fields", type=str, action='append', help="Recipe fields to return, or 'all'", location='json')
+
+MAX_BATCH_USERS = 1000
+
+class RecipeBatch(Resource):
+    def post(self):
+        """
+        Recommends recipes to many users sharing the same filters, scoring them together.
+
+        Each user's result is the same first page as /recommend/recipe would return for them, and goes
+        through the same cached ranked lists.
+        """
+        args = recipe_batch_args.parse_args()
+        data = loaded_data()
+        usernames = args.pop('usernames')
+
+        if len(usernames) > MAX_BATCH_USERS:
+            abort(413, {'error': f'At most {MAX_BATCH_USERS} users can be sent at once'})
+
+        if args['top_k'] < 1:
+            abort(400, {'error': 'top_k must be a positive integer'})
+
+        model_version = data.model_versions['recipe']
+        fields = parse_fields(data, args['fields'])
+        state = {'filters': recipe_filters(args), 'top_k': args['top_k'], 'offset': 0, 'model_version': model_version}
+        length = max(RANKED_LIST_SIZE, args['top_k'])
+        ranked_ids = {}
+        missing = []
+        pending_by_daily = {}
+        for username in dict.fromkeys(usernames):
+            user = get_profile(username)
+            if not user:
+                missing.append(username)
+                continue
+
+            cache_key = recipe_list_key(user, state['filters'], length, model_version)
+            ids = recommendation_cache.get(cache_key)
+            if ids is not None:
+                ranked_ids[username] = ids
+            else:
+                # The nutrient limits scale with the daily calorie goal, so users are scored in groups sharing one
+                pending_by_daily.setdefault(daily_calories(user), []).append((username, user, cache_key))
+
+        for daily, pending in pending_by_daily.items():
+            users = [(user.user_id, data.user_rating_count('recipe', user.user_id) if data.is_user_in_filter(user.user_id, data.recipe_colab_filter) else 0)
+                     for _, user, _ in pending]
+            recipes_found = getRecipesForUsers(data.recipes, users, colab_filter=data.recipe_colab_filter,
+                                               calories=args['calories'], daily=daily,
+                                               fat=args['fat'], sat_fat=args['sat_fat'],
+                                               sugar=args['sugar'], sodium=args['sodium'], protein=args['protein'],
+                                               carbs=args['carbs'], tags=args['tags'] or [],
+                                               tag_index=data.recipe_tag_index, tag_match=args['tag_match'],
+                                               nutrient_index=data.recipe_nutrient_index, top_k=length)
+            for (username, _, cache_key), user_recipes in zip(pending, recipes_found):
+                ids = user_recipes['id'].tolist()
+                recommendation_cache.set(cache_key, ids)
+                ranked_ids[username] = ids
+
+        results = {username: recipe_page(data, ranked_ids[username], fields, state) for username in dict.fromkeys(usernames) if username in ranked_ids}
+        return {'results': results, 'missing': missing}, 200, {'X-Model-Version': str(model_version)}
 
 diet_recommendation_get_args = reqparse.RequestParser()
 diet_recommendation_get_args.add_argument("username", type=str, help="Enter Username", location='args', required=True)
@@ -340,7 +616,7 @@ diet_recommendation_get_args.add_argument("username", type=str, help="Enter User
 class DietRecommendation(Resource):
     def get(self):
         args = diet_recommendation_get_args.parse_args()
-        user = DBUsers.query.filter_by(username=args['username']).first()
+        user = get_profile(args['username'])
 
         if not user:
             abort(404, {'error': 'User not found'})
@@ -431,10 +707,11 @@ class DietRecommendation(Resource):
 
 exercise_get_args = reqparse.RequestParser()
 exercise_get_args.add_argument("username", type=str, help="Enter Username", location='args', required=True)
-exercise_get_args.add_argument("type", type=int, help="Enter the type of exercise", location='args')
+exercise_get_args.add_argument("type", type=str, help="Enter the type of exercise", location='args')
 exercise_get_args.add_argument("body_part", type=str, help="Enter the main body part the exercise is for", location='args')
 exercise_get_args.add_argument("equipment", type=str, help="Enter the equipment used in the exercise", location='args')
 exercise_get_args.add_argument("level", type=str, help="Enter the difficulty level", location='args')
+exercise_get_args.add_argument("top_k", type=int, default=5, help="Number of exercises to return", location='args')
 
 exercise_put_args = reqparse.RequestParser()
 exercise_put_args.add_argument("username", type=str, help="Enter Username", location='args', required=True)
@@ -443,37 +720,51 @@ exercise_put_args.add_argument("rating", type=int, help="Enter the rating, integ
 
 class Exercise(Resource):
     def get(self):
-        args = recipe_get_args.parse_args()
-        user = DBUsers.query.filter_by(username=args['username']).first()
+        args = exercise_get_args.parse_args()
+        data = loaded_data()
+        user = get_profile(args['username'])
 
         if not user:
             abort(404, {'error': 'User not found'})
+
+        if args['top_k'] < 1:
+            abort(400, {'error': 'top_k must be a positive integer'})
         
-        if not args['type'] in ['Strength', 'Plyometrics', 'Stretching', 'Powerlifting', 'Strongman', 'Cardio', 'Olympic Weightlifting']:
-            abort(400, {'error': "Invalid type. Valid types: 'Strength' 'Plyometrics' 'Stretching' 'Powerlifting' 'Strongman' 'Cardio' 'Olympic Weightlifting'"})
-        
-        if not args['body_part'] in ['Abdominals', 'Abductors', 'Adductors', 'Biceps', 'Calves', 'Chest', 'Forearms', 'Glutes', 'Hamstrings', 'Lats', 'Lower Back', 'Middle Back', 'Traps', 'Quadriceps', 'Shoulders', 'Triceps']:
-            abort(400, {'error': "Invalid body part. Valid body parts: 'Abdominals' 'Abductors' 'Adductors' 'Biceps' 'Calves' 'Chest' 'Forearms' 'Glutes' 'Hamstrings' 'Lats' 'Lower Back' 'Middle Back' 'Traps' 'Quadriceps' 'Shoulders' 'Triceps'"})
-        
-        if not args['equipment'] in ['Bands', 'Barbell', 'Kettlebells', 'Dumbbell', 'Other', 'Cable', 'Machine', 'Body Only', 'Medicine Ball', 'Exercise Ball', 'Foam Roll', 'E-Z Curl Bar']:
-            abort(400, {'error': "Invalid equipment. Valid equipment: 'Bands' 'Barbell' 'Kettlebells' 'Dumbbell' 'Other' 'Cable' 'Machine' 'Body Only' 'Medicine Ball' 'Exercise Ball' 'Foam Roll' 'E-Z Curl Bar'"})
-        
-        if not args['level'] in ['Intermediate', 'Beginner', 'Expert']:
-            abort(400, {'error': "Invalid level. Valid level: 'Intermediate' 'Beginner' 'Expert'"})
-
-        if data_management.data.is_user_in_filter(user.user_id, data_management.data.exercise_colab_filter_trainset):
-            resp = getExerciseWithConfiguration(data_management.data.exercises, user.user_id, (data_management.data.exercise_ratings['user_id'] == user.user_id).sum(),
-                                                colab_filter=data_management.data.exercise_colab_filter,
-                                                type=args['type'], body_part=args['body_part'], equipment=args['equipment'], level=args['level'])
-        else:        
-            resp = getExerciseWithConfiguration(data_management.data.exercises, user.user_id, 0, colab_filter=None,
-                                                type=args['type'], body_part=args['body_part'], equipment=args['equipment'], level=args['level'])
-
-        return resp[:5].to_dict()
+        exercise_index = data.exercise_index
+        for arg, column, label, plural in [('type', 'Type', 'type', 'types'), ('body_part', 'BodyPart', 'body part', 'body parts'),
+                                           ('equipment', 'Equipment', 'equipment', 'equipment'), ('level', 'Level', 'level', 'level')]:
+            if args[arg] is not None and not args[arg] in exercise_index.values(column):
+                valid_values = ' '.join(f"'{value}'" for value in exercise_index.values(column))
+                abort(400, {'error': f"Invalid {label}. Valid {plural}: {valid_values}"})
+
+        model_version = data.model_versions['exercise']
+        cache_key = recommendation_cache.key('exercise', user.user_id, args, model_version)
+        cached_resp = recommendation_cache.get(cache_key)
+        if cached_resp is not None:
+            return cached_resp, 200, {'X-Model-Version': str(model_version)}
+
+        # Unfiltered requests are what precompute.py ranks ahead of time for every user
+        unfiltered = all(args[arg] is None for arg in ('type', 'body_part', 'equipment', 'level'))
+        resp = data.precomputed_exercises(user.user_id, args['top_k']) if unfiltered else None
+        if resp is None and data.is_user_in_filter(user.user_id, data.exercise_colab_filter):
+            resp = getExerciseWithConfiguration(data.exercises, user.user_id, data.user_rating_count('exercise', user.user_id),
+                                                colab_filter=data.exercise_colab_filter,
+                                                type=args['type'], body_part=args['body_part'], equipment=args['equipment'], level=args['level'],
+                                                top_k=args['top_k'], exercise_index=exercise_index)
+        elif resp is None:
+            resp = getExerciseWithConfiguration(data.exercises, user.user_id, 0, colab_filter=None,
+                                                type=args['type'], body_part=args['body_part'], equipment=args['equipment'], level=args['level'],
+                                                top_k=args['top_k'], exercise_index=exercise_index)
+
+        with metrics.STAGE_SECONDS.time('serialize'):
+            resp = data_management.response_frame(resp).to_dict()
+        recommendation_cache.set(cache_key, resp)
+        return resp, 200, {'X-Model-Version': str(model_version)}
     
     def put(self):
         args = exercise_put_args.parse_args()
-        user = DBUsers.query.filter_by(username=args['username']).first()
+        data = loaded_data()
+        user = get_profile(args['username'])
 
         if not user:
             abort(404, {'error': 'User not found'})
@@ -481,25 +772,31 @@ class Exercise(Resource):
         if not args['rating'] in [0, 1, 2, 3, 4, 5]:
             abort(400, {'error': 'Rating not integer in range [0, 5]'})
 
-        if not args['exercise_id'] in data_management.data.exercises['id'].values:
+        if not data.has_item('exercise', args['exercise_id']):
             abort(404, {'error': 'Invalid exercise_id'})
         
-        user_rating = DBExerciseRatings.query.filter_by(user_id=user.user_id, exercise_id=args['exercise_id']).first()
-        if user_rating is None:        
-            new_rating = DBExerciseRatings(user_id=user.user_id, exercise_id=args['exercise_id'], rating=args['rating'])
-            db.session.add(new_rating)
-            db.session.commit()
+        if rating_buffer is not None:
+            rating_buffer.add('exercise', user.user_id, args['exercise_id'], args['rating'])
         else:
-            user_rating.rating = args['rating']
-            db.session.commit()
+            user_rating = db.session.get(DBExerciseRatings, (user.user_id, args['exercise_id']))
+            if user_rating is None:
+                new_rating = DBExerciseRatings(user_id=user.user_id, exercise_id=args['exercise_id'], rating=args['rating'])
+                db.session.add(new_rating)
+                db.session.commit()
+            else:
+                user_rating.rating = args['rating']
+                db.session.commit()
+
+        data.add_rating('exercise', user.user_id, args['exercise_id'], args['rating'])
+        recommendation_cache.invalidate_user(user.user_id)
         
-        return {"data": {"username": args['username']}}, 201
+        return {"data": {"username": args['username']}}, 202 if rating_buffer is not None else 201
     
 
 class Lifestyle(Resource):
     def get(self):
         args = diet_recommendation_get_args.parse_args()
-        user = DBUsers.query.filter_by(username=args['username']).first()
+        user = get_profile(args['username'])
 
         if not user:
             abort(404, {'error': 'User not found'})
@@ -512,15 +809,194 @@ class Lifestyle(Resource):
                 
         return get_lifestyle_score(user, 7, 2248, 6785)
     
+bulk_ratings_args = reqparse.RequestParser()
+bulk_ratings_args.add_argument("username", type=str, help="Enter Username", location='json', required=True)
+bulk_ratings_args.add_argument("ratings", type=dict, action='append', location='json', required=True,
+                               help="List of ratings, each with an item_type ('recipe' or 'exercise'), an item_id and a rating (integer from 0 to 5 inclusive)")
+
+MAX_BULK_RATINGS = 1000
+
+# Model and item id column holding each item type's ratings
+RATING_MODELS = {
+    'recipe': (DBRecipeRatings, 'recipe_id'),
+    'exercise': (DBExerciseRatings, 'exercise_id'),
+}
+
+def upsert_ratings(kind, rows):
+    """
+    Inserts or updates (user id, item id, rating) rows of one kind in the current session with a single executemany.
+    """
+    model, item_column = RATING_MODELS[kind]
+    statement = sqlite_insert(model)
+    statement = statement.on_conflict_do_update(index_elements=[model.user_id, getattr(model, item_column)],
+                                                set_={'rating': statement.excluded.rating})
+    db.session.execute(statement, [{'user_id': user_id, item_column: item_id, 'rating': rating} for user_id, item_id, rating in rows])
+
+def write_buffered_ratings(rows):
+    with app.app_context():
+        for kind, kind_rows in rows.items():
+            upsert_ratings(kind, kind_rows)
+        db.session.commit()
+
+rating_buffer = RatingWriteBuffer(write_buffered_ratings, flush_interval=app.config['RATING_FLUSH_INTERVAL'],
+                                  max_pending=app.config['RATING_FLUSH_MAX_PENDING']) if app.config['RATING_WRITE_BEHIND'] else None
+
+class Ratings(Resource):
+    def post(self):
+        """
+        Writes a batch of one user's recipe and exercise ratings in a single transaction.
+
+        Each entry gets a status in the response: 'created', 'updated', 'superseded' by a later entry
+        for the same item, or 'invalid' with the reason.
+        """
+        args = bulk_ratings_args.parse_args()
+        data = loaded_data()
+        user = get_profile(args['username'])
+
+        if not user:
+            abort(404, {'error': 'User not found'})
+
+        if len(args['ratings']) > MAX_BULK_RATINGS:
+            abort(413, {'error': f'At most {MAX_BULK_RATINGS} ratings can be sent at once'})
+
+        results = []
+        latest = {kind: {} for kind in RATING_MODELS}
+        for position, entry in enumerate(args['ratings']):
+            kind, item_id, rating = entry.get('item_type'), entry.get('item_id'), entry.get('rating')
+            results.append({'item_type': kind, 'item_id': item_id, 'rating': rating})
+            if kind not in RATING_MODELS:
+                results[-1].update(status='invalid', error="item_type must be 'recipe' or 'exercise'")
+            elif type(item_id) != int or not data.has_item(kind, item_id):
+                results[-1].update(status='invalid', error=f'Invalid {kind}_id')
+            elif not (type(rating) is int and 0 <= rating <= 5):
+                results[-1].update(status='invalid', error='Rating not integer in range [0, 5]')
+            else:
+                if item_id in latest[kind]:
+                    results[latest[kind][item_id]]['status'] = 'superseded'
+                latest[kind][item_id] = position
+
+        if not any(latest.values()):
+            return {'data': {'username': args['username'], 'results': results}}, 400
+
+        if rating_buffer is not None:
+            # Buffered ratings are older than this batch and must not overwrite it when flushed later
+            rating_buffer.flush()
+
+        for kind, positions in latest.items():
+            if not positions:
+                continue
+            model, item_column = RATING_MODELS[kind]
+            item_id_column = getattr(model, item_column)
+            existing = {item_id for item_id, in db.session.query(item_id_column).filter(
+                model.user_id == user.user_id, item_id_column.in_(list(positions)))}
+
+            upsert_ratings(kind, [(user.user_id, item_id, results[position]['rating']) for item_id, position in positions.items()])
+            for item_id, position in positions.items():
+                results[position]['status'] = 'updated' if item_id in existing else 'created'
+        db.session.commit()
+
+        for kind, positions in latest.items():
+            if positions:
+                data.add_ratings(kind, user.user_id, {item_id: results[position]['rating'] for item_id, position in positions.items()})
+        recommendation_cache.invalidate_user(user.user_id)
+
+        return {'data': {'username': args['username'], 'results': results}}, 201
+
+class RecommendationCacheStats(Resource):
+    def get(self):
+        return recommendation_cache.stats()
+
+class RatingBufferStats(Resource):
+    def get(self):
+        if rating_buffer is None:
+            abort(404, {'error': 'Write-behind rating buffer is not enabled'})
+        return rating_buffer.stats()
+
+class ProfileCacheStats(Resource):
+    def get(self):
+        return profile_cache.stats()
+
+class RetrainingStatus(Resource):
+    def get(self):
+        return retrain_scheduler.status()
+
+class Readiness(Resource):
+    def get(self):
+        return preloader.status(), 200 if preloader.ready else 503
+
+class Metrics(Resource):
+    def get(self):
+        return Response(metrics.registry.render(), content_type=metrics.CONTENT_TYPE)
+
+REQUEST_SECONDS = metrics.registry.histogram('smartshop_request_seconds', "Time spent handling each request", ['endpoint', 'method', 'status'])
+
+metrics.registry.gauge('smartshop_data_last_load_seconds', "Duration of each load stage of the DataManager currently serving", ['stage'],
+                       lambda: {(stage,): seconds for stage, seconds in data_management.data.load_timings.items()} if data_management.data else {})
+metrics.registry.gauge('smartshop_data_age_seconds', "Seconds since the DataManager currently serving was loaded", (),
+                       lambda: {(): time.time() - data_management.data.loaded_at if data_management.data else None})
+metrics.registry.gauge('smartshop_cache_entries', "Entries in the in-process caches", ['cache'],
+                       lambda: {('recommendation',): recommendation_cache.stats()['entries'], ('profile',): profile_cache.stats()['entries']})
+metrics.registry.gauge('smartshop_rating_buffer_depth', "Ratings waiting in the write-behind buffer", (),
+                       lambda: {(): rating_buffer.stats()['queue_depth'] if rating_buffer is not None else None})
+
+profiler = metrics.SampledProfiler(sample_rate=app.config['PROFILER_SAMPLE_RATE'], output_dir=app.config['PROFILER_DIR'])
+
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+    g.profile = profiler.start() if app.config['PROFILER_ENABLED'] and request.headers.get('X-Profile') else None
+
+@app.after_request
+def record_request_time(response):
+    if g.get('profile') is not None:
+        response.headers['X-Profile-File'] = profiler.stop(g.pop('profile'), request.endpoint or 'unknown')
+    if 'request_start' in g:
+        REQUEST_SECONDS.observe(time.perf_counter() - g.request_start, request.endpoint or 'unknown', request.method, response.status_code)
+    return response
+
+@app.teardown_request
+def stop_abandoned_profile(error=None):
+    # A request that failed before after_request still has to release the profiler
+    if g.get('profile') is not None:
+        profiler.stop(g.pop('profile'), request.endpoint or 'unknown')
+
 api.add_resource(Recipe, "/recommend/recipe")
+api.add_resource(RecipeBatch, "/recommend/recipe/batch")
 api.add_resource(Exercise, "/recommend/exercise")
 api.add_resource(DietRecommendation, "/recommend/diet")
+api.add_resource(RecommendationCacheStats, "/recommend/cache")
+api.add_resource(RetrainingStatus, "/retraining")
+api.add_resource(Readiness, "/health/ready")
+api.add_resource(Metrics, "/metrics")
 api.add_resource(User, "/user")
+api.add_resource(ProfileCacheStats, "/user/cache")
+api.add_resource(Ratings, "/ratings")
+api.add_resource(RatingBufferStats, "/ratings/buffer")
 
 api.add_resource(Lifestyle, "/lifestyle")
 
-if __name__ == '__main__':
+def create_app():
+    """
+    Creates the database tables and starts loading the data and the retraining scheduler in the background.
+
+    The app answers right away: recommendation requests get a 503 and /health/ready reports the load
+    progress until the data is loaded and warmed up. Serve it with e.g. gunicorn "main:create_app()",
+    or asynchronously through asgi.py.
+
+    With RATING_WRITE_BEHIND set, rating writes are buffered and flushed in the background, and the
+    buffer is drained when the process exits.
+    """
+    storage.make_database_dir()
     with app.app_context():
+        storage.use_engine(db.engine)
         db.create_all()
-        data_management.data = data_management.DataManager()
-    app.run(port=5000, debug=True)
\ No newline at end of file
+        storage.import_legacy_databases(db.engine)
+    preloader.start()
+    retrain_scheduler.start()
+    if rating_buffer is not None:
+        rating_buffer.start()
+        atexit.register(rating_buffer.stop)
+    return app
+
+if __name__ == '__main__':
+    create_app().run(port=5000, debug=True)
\ No newline at end of file
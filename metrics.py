@@ -0,0 +1,149 @@
+import bisect
+import cProfile
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Seconds, from sub-millisecond index lookups up to full data loads and retrains
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+SIZE_BUCKETS = (0, 1, 10, 100, 1000, 10000, 100000, 1000000)
+
+def format_labels(names, values, extra=()):
+    pairs = [*zip(names, values), *extra]
+    if not pairs:
+        return ""
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+def format_value(value):
+    if value == float('inf'):
+        return "+Inf"
+    return repr(float(value))
+
+class Histogram:
+    """
+    Prometheus histogram with one series per combination of label values.
+    """
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS) -> None:
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        with self.lock:
+            series = self.series.get(label_values)
+            if series is None:
+                series = self.series[label_values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][bisect.bisect_left(self.buckets, value)] += 1
+            series[1] += value
+            series[2] += 1
+
+    @contextmanager
+    def time(self, *label_values):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *label_values)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            series = {label_values: (list(counts), total, count) for label_values, (counts, total, count) in self.series.items()}
+        for label_values, (counts, total, count) in sorted(series.items()):
+            cumulative = 0
+            for bound, bucket_count in zip((*self.buckets, float('inf')), counts):
+                cumulative += bucket_count
+                lines.append(f"{self.name}_bucket{format_labels(self.labels, label_values, [('le', format_value(bound))])} {cumulative}")
+            lines.append(f"{self.name}_sum{format_labels(self.labels, label_values)} {format_value(total)}")
+            lines.append(f"{self.name}_count{format_labels(self.labels, label_values)} {count}")
+        return lines
+
+class Gauge:
+    """
+    Prometheus gauge whose values are read when the metrics are scraped.
+
+    collect returns a dict of label values, as a tuple, to value. Series whose value is None are left out.
+    """
+    def __init__(self, name, help, labels=(), collect=None) -> None:
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.collect = collect
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge"]
+        for label_values, value in sorted(self.collect().items()):
+            if value is not None:
+                lines.append(f"{self.name}{format_labels(self.labels, label_values)} {format_value(value)}")
+        return lines
+
+class Registry:
+    def __init__(self) -> None:
+        self.metrics = {}
+
+    def register(self, metric):
+        self.metrics[metric.name] = metric
+        return metric
+
+    def histogram(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, help, labels, buckets))
+
+    def gauge(self, name, help, labels=(), collect=None):
+        return self.register(Gauge(name, help, labels, collect))
+
+    def render(self):
+        """
+        Returns every metric in the Prometheus text exposition format.
+        """
+        return "\n".join(line for metric in self.metrics.values() for line in metric.render()) + "\n"
+
+registry = Registry()
+
+# Hot-path stages of the recommendation pipeline, recorded by recommend.py, data_management.py and main.py
+STAGE_SECONDS = registry.histogram('smartshop_stage_seconds', "Time spent in each recommendation stage", ['stage'])
+CANDIDATES = registry.histogram('smartshop_candidates', "Number of items left after each filtering stage", ['stage'], buckets=SIZE_BUCKETS)
+LOAD_SECONDS = registry.histogram('smartshop_data_load_seconds', "Time spent in each DataManager load stage", ['stage'])
+MODEL_SECONDS = registry.histogram('smartshop_model_seconds', "Time spent retraining the models and swapping in the retrained data", ['step'])
+
+class SampledProfiler:
+    """
+    Profiles single requests with cProfile when asked to, for at most sample_rate of the requests that ask.
+
+    Only one request is profiled at a time. Each profile is written to output_dir as a .prof file that
+    pstats, snakeviz and the like can read.
+    """
+    def __init__(self, sample_rate=1.0, output_dir="instance/profiles") -> None:
+        self.sample_rate = sample_rate
+        self.output_dir = output_dir
+        self.lock = threading.Lock()
+
+    def start(self):
+        """
+        Returns a running profiler if this request is sampled and no other request is being profiled, otherwise None.
+        """
+        if random.random() >= self.sample_rate or not self.lock.acquire(blocking=False):
+            return None
+        profile = cProfile.Profile()
+        profile.enable()
+        return profile
+
+    def stop(self, profile, name):
+        """
+        Stops a profiler returned by start and returns the path of the written profile.
+        """
+        profile.disable()
+        try:
+            os.makedirs(self.output_dir, exist_ok=True)
+            path = os.path.join(self.output_dir, f"{time.strftime('%Y%m%dT%H%M%S')}-{name}-{os.getpid()}-{threading.get_ident()}.prof")
+            profile.dump_stats(path)
+            return path
+        finally:
+            self.lock.release()
@@ -0,0 +1,251 @@
+import argparse
+import hashlib
+import json
+import os
+import time
+
+import numpy as np
+from surprise import Dataset, Reader, SVD
+
+from publishing import staged_dir, write_pointer
+
+MODELS_DIR = "models"
+CURRENT_FILE = "CURRENT"
+MANIFEST_FILE = "manifest.json"
+ARTIFACT_VERSION = 1
+
+# Seeded, so every worker training on the same ratings gets the same model and the same version
+SVD_PARAMS = {'n_factors': 1, 'n_epochs': 1, 'biased': True, 'lr_all': 0.005, 'reg_all': 0.2, 'random_state': 0}
+
+FOLD_IN_STEPS = 20
+FOLD_IN_LR = 0.05
+
+class FactorModel:
+    """
+    Trained matrix factorization model: user/item factors, biases and raw to inner id maps.
+
+    This is everything recommendation scoring needs from a fitted Surprise SVD, in a form that can be
+    saved as an artifact and memory-mapped back in.
+    """
+    def __init__(self, pu, qi, bu, bi, global_mean, rating_scale, biased, raw_user_ids, raw_item_ids, version=None, metadata=None) -> None:
+        self.pu = pu
+        self.qi = qi
+        self.bu = bu
+        self.bi = bi
+        self.global_mean = global_mean
+        self.rating_scale = tuple(rating_scale)
+        self.biased = biased
+        self.raw_user_ids = raw_user_ids
+        self.raw_item_ids = raw_item_ids
+        self.metadata = metadata or {}
+        self.folded_in_users = {}
+
+        self.raw2inner_users = {raw_id: inner_id for inner_id, raw_id in enumerate(np.asarray(raw_user_ids).tolist())}
+        self._item_order = np.argsort(raw_item_ids, kind='stable')
+        self._sorted_item_ids = np.asarray(raw_item_ids)[self._item_order]
+
+        self.version = version or self.content_version()
+
+    @classmethod
+    def from_svd(cls, svd, metadata=None):
+        trainset = svd.trainset
+        raw_user_ids = np.empty(trainset.n_users, dtype=np.int64)
+        for raw_id, inner_id in trainset._raw2inner_id_users.items():
+            raw_user_ids[inner_id] = raw_id
+        raw_item_ids = np.empty(trainset.n_items, dtype=np.int64)
+        for raw_id, inner_id in trainset._raw2inner_id_items.items():
+            raw_item_ids[inner_id] = raw_id
+
+        return cls(svd.pu, svd.qi, svd.bu, svd.bi, trainset.global_mean, trainset.rating_scale, svd.biased,
+                   raw_user_ids, raw_item_ids, metadata=metadata)
+
+    def content_version(self):
+        """
+        Returns a checksum of the trained arrays, so the same model gets the same version in every process.
+        """
+        checksum = hashlib.blake2b(digest_size=8)
+        for array in (self.pu, self.qi, self.bu, self.bi, self.raw_user_ids, self.raw_item_ids):
+            checksum.update(np.ascontiguousarray(array).tobytes())
+        checksum.update(json.dumps([float(self.global_mean), list(self.rating_scale), bool(self.biased)]).encode())
+        return checksum.hexdigest()
+
+    def knows_user(self, raw_uid):
+        return raw_uid in self.folded_in_users or raw_uid in self.raw2inner_users
+
+    def user_factors(self, raw_uid):
+        """
+        Returns the user's (bias, factor vector), preferring folded-in values over trained ones, or None for an unknown user.
+        """
+        if raw_uid in self.folded_in_users:
+            return self.folded_in_users[raw_uid]
+        inner_uid = self.raw2inner_users.get(raw_uid)
+        if inner_uid is None:
+            return None
+        return self.bu[inner_uid], self.pu[inner_uid]
+
+    def fold_in_user(self, raw_uid, raw_iids, ratings, n_steps=FOLD_IN_STEPS, lr=FOLD_IN_LR):
+        """
+        Fits only the user's bias and factor vector to their ratings, keeping the item factors frozen.
+
+        Runs a few full-batch gradient steps starting from the user's current factors, or from zero for a
+        user the model was not trained on. The result is kept alongside the trained arrays, which stay untouched.
+
+        Returns:
+            bool: False if none of the rated items are known to the model.
+        """
+        inner_iids = self.inner_item_ids(raw_iids)
+        known_items = inner_iids >= 0
+        if not known_items.any():
+            return False
+
+        qi = np.asarray(self.qi[inner_iids[known_items]], dtype=float)
+        bi = np.asarray(self.bi[inner_iids[known_items]], dtype=float)
+        ratings = np.asarray(ratings, dtype=float)[known_items]
+        reg = self.metadata.get('params', {}).get('reg_all', SVD_PARAMS['reg_all'])
+
+        current = self.user_factors(raw_uid)
+        if current is None:
+            bu, pu = 0.0, np.zeros(qi.shape[1])
+        else:
+            bu, pu = float(current[0]), np.array(current[1], dtype=float)
+
+        for _ in range(n_steps):
+            estimates = qi @ pu
+            if self.biased:
+                estimates += self.global_mean + bu + bi
+            errors = ratings - estimates
+            if self.biased:
+                bu += lr * (errors.mean() - reg * bu)
+            pu += lr * (qi.T @ errors / len(errors) - reg * pu)
+
+        self.folded_in_users[raw_uid] = (bu, pu)
+        return True
+
+    def inner_item_ids(self, raw_iids):
+        """
+        Maps raw item ids to inner ids with a binary search, using -1 for items the model was not trained on.
+        """
+        raw_iids = np.asarray(raw_iids)
+        if len(self._sorted_item_ids) == 0:
+            return np.full(len(raw_iids), -1, dtype=np.int64)
+        positions = np.searchsorted(self._sorted_item_ids, raw_iids).clip(max=len(self._sorted_item_ids) - 1)
+        known = self._sorted_item_ids[positions] == raw_iids
+        return np.where(known, self._item_order[positions], -1)
+
+    def save(self, model_dir):
+        os.makedirs(model_dir, exist_ok=True)
+        for name in ('pu', 'qi', 'bu', 'bi', 'raw_user_ids', 'raw_item_ids'):
+            np.save(os.path.join(model_dir, f"{name}.npy"), np.asarray(getattr(self, name)))
+        manifest = {
+            'artifact_version': ARTIFACT_VERSION,
+            'version': self.version,
+            'global_mean': float(self.global_mean),
+            'rating_scale': list(self.rating_scale),
+            'biased': bool(self.biased),
+            'metadata': self.metadata,
+        }
+        with open(os.path.join(model_dir, MANIFEST_FILE), 'w') as file:
+            json.dump(manifest, file, indent=2)
+
+    @classmethod
+    def load(cls, model_dir, mmap=True):
+        with open(os.path.join(model_dir, MANIFEST_FILE)) as file:
+            manifest = json.load(file)
+        if manifest['artifact_version'] != ARTIFACT_VERSION:
+            raise ValueError(f"Unsupported model artifact version {manifest['artifact_version']} in {model_dir}")
+
+        arrays = {name: np.load(os.path.join(model_dir, f"{name}.npy"), mmap_mode='r' if mmap else None)
+                  for name in ('pu', 'qi', 'bu', 'bi', 'raw_user_ids', 'raw_item_ids')}
+        return cls(global_mean=manifest['global_mean'], rating_scale=manifest['rating_scale'], biased=manifest['biased'],
+                   version=manifest['version'], metadata=manifest['metadata'], **arrays)
+
+def train_svd(ratings, user_column, item_column, rating_column='rating', rating_scale=(0, 5), **params):
+    """
+    Fits an SVD on a ratings frame and returns it as a FactorModel with its training metadata.
+    """
+    params = {**SVD_PARAMS, **params}
+    start = time.perf_counter()
+    data = Dataset.load_from_df(ratings[[user_column, item_column, rating_column]], Reader(rating_scale=rating_scale))
+    trainset = data.build_full_trainset()
+    svd = SVD(**params)
+    svd.fit(trainset)
+
+    metadata = {
+        'algorithm': 'SVD',
+        'params': params,
+        'n_ratings': trainset.n_ratings,
+        'n_users': trainset.n_users,
+        'n_items': trainset.n_items,
+        'trained_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'training_seconds': round(time.perf_counter() - start, 3),
+    }
+    return FactorModel.from_svd(svd, metadata=metadata)
+
+def publish(model, name, models_dir=MODELS_DIR):
+    """
+    Saves model as a new version of the named artifact and makes it the current one.
+
+    Versions are content checksums, so a version that was already saved holds the same model and is not written again.
+    """
+    model_dir = os.path.join(models_dir, name, model.version)
+    if not os.path.isdir(model_dir):
+        with staged_dir(model_dir) as staging_dir:
+            model.save(staging_dir)
+    write_pointer(os.path.join(models_dir, name, CURRENT_FILE), model.version)
+    return model_dir
+
+def publish_trained(models, models_dir=MODELS_DIR):
+    """
+    Publishes the models of a dict of artifact name to model that are not saved in models_dir yet, such as
+    those a DataManager trained itself because nothing was published, so other processes load the same models.
+    """
+    for name, model in models.items():
+        if model is not None and not os.path.isdir(os.path.join(models_dir, name, model.version)):
+            publish(model, name, models_dir)
+
+def current_version(name, models_dir=MODELS_DIR):
+    """
+    Returns the current version of the named artifact, or None if none has been published.
+    """
+    try:
+        with open(os.path.join(models_dir, name, CURRENT_FILE)) as file:
+            return file.read().strip()
+    except OSError:
+        return None
+
+def load_current(name, models_dir=MODELS_DIR, mmap=True):
+    """
+    Loads the current version of the named artifact, or returns None if none has been published.
+    """
+    version = current_version(name, models_dir)
+    if version is None:
+        return None
+    return FactorModel.load(os.path.join(models_dir, name, version), mmap=mmap)
+
+def train_and_publish(models_dir=MODELS_DIR):
+    """
+    Trains the recipe and exercise models from the current data and publishes them.
+
+    Returns:
+        dict: Published version of each model, or None for a model with no ratings to train on.
+    """
+    import data_management
+
+    data = data_management.DataManager(models_dir=None)
+    versions = {}
+    for name, model in (('recipe', data.recipe_colab_filter), ('exercise', data.exercise_colab_filter)):
+        versions[name] = None
+        if model is not None:
+            publish(model, name, models_dir)
+            versions[name] = model.version
+    return versions
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Train the recommendation models offline and publish them as artifacts")
+    parser.add_argument('--models-dir', default=MODELS_DIR, help="Directory to publish the model artifacts to")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    for name, version in train_and_publish(args.models_dir).items():
+        print(f"{name}: " + (f"published {version}" if version else "no ratings to train on, skipped"))
+    print(f"Trained in {time.perf_counter() - start:.2f}s")
@@ -0,0 +1,218 @@
+import argparse
+import json
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+import numpy as np
+
+from model_store import MODELS_DIR, publish_trained
+from publishing import staged_dir
+from recommend import get_time_tags, getRecipesForUsers, getExerciseWithConfiguration
+
+PRECOMPUTED_DIR = "Data/precomputed"
+PRECOMPUTED_VERSION = 2
+MANIFEST_FILE = "manifest.json"
+PRECOMPUTED_TOP_N = 50
+CHUNK_USERS = 256
+
+# DataManager the pool workers score with, inherited from the parent when processes are forked
+_data = None
+
+def time_buckets():
+    """
+    Returns every distinct time context get_time_tags can produce, in a fixed order.
+    """
+    buckets = {tuple(get_time_tags(datetime(2001, month, 1, hour))) for month in range(1, 13) for hour in range(24)}
+    return sorted(buckets)
+
+def init_worker(models_dir, compact):
+    global _data
+    if _data is None:
+        import data_management
+        _data = data_management.DataManager(models_dir=models_dir, compact=compact)
+
+def compute_chunk(user_ids, buckets, top_n):
+    """
+    Ranks the recipes for a chunk of users in every time bucket, without filters.
+
+    Users the recipe model does not know are ranked as anonymous users. Pass [None] to rank only the anonymous list.
+
+    Returns:
+        tuple: (buckets x users x top_n) arrays of recipe ids and of result index labels, padded with -1.
+    """
+    data = _data
+    colab_filter = data.recipe_colab_filter
+    users = [(user_id, data.user_rating_count('recipe', user_id) if data.is_user_in_filter(user_id, colab_filter) else 0)
+             for user_id in user_ids]
+    ids = np.full((len(buckets), len(users), top_n), -1, dtype=np.int32)
+    labels = np.full((len(buckets), len(users), top_n), -1, dtype=np.int32)
+    for bucket, time_tags in enumerate(buckets):
+        recipes_found = getRecipesForUsers(data.recipes, users, colab_filter=colab_filter, tag_index=data.recipe_tag_index,
+                                           nutrient_index=data.recipe_nutrient_index, top_k=top_n, time_tags=list(time_tags))
+        for position, user_recipes in enumerate(recipes_found):
+            ids[bucket, position, :len(user_recipes)] = user_recipes['id'].to_numpy()
+            labels[bucket, position, :len(user_recipes)] = user_recipes.index.to_numpy()
+    return ids, labels
+
+def compute_exercise_chunk(user_ids, top_n):
+    """
+    Ranks the exercises for a chunk of users without filters, the same way as compute_chunk ranks recipes.
+
+    Returns:
+        np.ndarray: (users x top_n) positional exercise rows, padded with -1.
+    """
+    data = _data
+    colab_filter = data.exercise_colab_filter
+    rows = np.full((len(user_ids), top_n), -1, dtype=np.int32)
+    for position, user_id in enumerate(user_ids):
+        if data.is_user_in_filter(user_id, colab_filter):
+            exercises_found = getExerciseWithConfiguration(data.exercises, user_id, data.user_rating_count('exercise', user_id),
+                                                           colab_filter=colab_filter, top_k=top_n, exercise_index=data.exercise_index)
+        else:
+            exercises_found = getExerciseWithConfiguration(data.exercises, user_id, 0, top_k=top_n, exercise_index=data.exercise_index)
+        rows[position, :len(exercises_found)] = data.exercises.index.get_indexer(exercises_found.index)
+    return rows
+
+def model_user_ids(colab_filter):
+    return np.unique(np.asarray(colab_filter.raw_user_ids)) if colab_filter is not None else np.array([], dtype=np.int64)
+
+def build_precomputed(data, precomputed_dir=PRECOMPUTED_DIR, models_dir=MODELS_DIR, top_n=PRECOMPUTED_TOP_N, workers=None, chunk_users=CHUNK_USERS):
+    """
+    Precomputes the unfiltered top_n recipes of every user the recipe model knows in every time bucket, and
+    the unfiltered top_n exercises of every user the exercise model knows, splitting the users across a
+    process pool, and writes them as a memory-mappable store.
+
+    Models the DataManager trained itself are published to models_dir first, so the store is computed with
+    the same models the server and the pool workers load.
+    """
+    global _data
+    _data = data
+    publish_trained({'recipe': data.recipe_colab_filter, 'exercise': data.exercise_colab_filter}, models_dir)
+    buckets = time_buckets()
+    user_ids = model_user_ids(data.recipe_colab_filter)
+    chunks = [user_ids[start:start + chunk_users].tolist() for start in range(0, len(user_ids), chunk_users)]
+    exercise_user_ids = model_user_ids(data.exercise_colab_filter)
+    exercise_chunks = [exercise_user_ids[start:start + chunk_users].tolist() for start in range(0, len(exercise_user_ids), chunk_users)]
+
+    context = multiprocessing.get_context('fork' if 'fork' in multiprocessing.get_all_start_methods() else 'spawn')
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=init_worker, initargs=(models_dir, data.compact)) as pool:
+        anonymous = pool.submit(compute_chunk, [None], buckets, top_n)
+        anonymous_exercises = pool.submit(compute_exercise_chunk, [None], top_n)
+        exercise_results = pool.map(compute_exercise_chunk, exercise_chunks, [top_n] * len(exercise_chunks))
+        results = list(pool.map(compute_chunk, chunks, [buckets] * len(chunks), [top_n] * len(chunks)))
+        exercise_results = list(exercise_results)
+
+    manifest = {
+        'version': PRECOMPUTED_VERSION,
+        'created': time.time(),
+        'top_n': top_n,
+        'buckets': [list(bucket) for bucket in buckets],
+        'model_versions': data.model_versions,
+        'users': len(user_ids),
+        'exercise_users': len(exercise_user_ids),
+    }
+    empty = np.full((len(buckets), 0, top_n), -1, dtype=np.int32)
+    with staged_dir(precomputed_dir) as staging_dir:
+        np.save(os.path.join(staging_dir, "user_ids.npy"), user_ids.astype(np.int64))
+        np.save(os.path.join(staging_dir, "recipe_ids.npy"), np.concatenate([ids for ids, _ in results], axis=1) if results else empty)
+        np.save(os.path.join(staging_dir, "recipe_labels.npy"), np.concatenate([labels for _, labels in results], axis=1) if results else empty)
+        anonymous_ids, anonymous_labels = anonymous.result()
+        np.save(os.path.join(staging_dir, "anonymous_recipe_ids.npy"), anonymous_ids[:, 0])
+        np.save(os.path.join(staging_dir, "anonymous_recipe_labels.npy"), anonymous_labels[:, 0])
+        np.save(os.path.join(staging_dir, "exercise_user_ids.npy"), exercise_user_ids.astype(np.int64))
+        np.save(os.path.join(staging_dir, "exercise_rows.npy"), np.concatenate(exercise_results) if exercise_results
+                else np.full((0, top_n), -1, dtype=np.int32))
+        np.save(os.path.join(staging_dir, "anonymous_exercise_rows.npy"), anonymous_exercises.result()[0])
+
+        with open(os.path.join(staging_dir, MANIFEST_FILE), 'w') as file:
+            json.dump(manifest, file, indent=2)
+    return manifest
+
+class PrecomputedStore:
+    """
+    Precomputed unfiltered recipe and exercise lists, memory-mapped, for serving requests without filters.
+    """
+    def __init__(self, precomputed_dir, manifest) -> None:
+        self.manifest = manifest
+        self.top_n = manifest['top_n']
+        self.model_versions = manifest['model_versions']
+        self.buckets = {tuple(bucket): position for position, bucket in enumerate(manifest['buckets'])}
+        load = lambda name: np.load(os.path.join(precomputed_dir, f"{name}.npy"), mmap_mode='r')
+        self.user_ids = load("user_ids")
+        self.recipe_ids = load("recipe_ids")
+        self.recipe_labels = load("recipe_labels")
+        self.anonymous_recipe_ids = load("anonymous_recipe_ids")
+        self.anonymous_recipe_labels = load("anonymous_recipe_labels")
+        self.exercise_user_ids = load("exercise_user_ids")
+        self.exercise_rows = load("exercise_rows")
+        self.anonymous_exercise_rows = load("anonymous_exercise_rows")
+
+    @classmethod
+    def open(cls, precomputed_dir=PRECOMPUTED_DIR):
+        """
+        Returns the store in precomputed_dir, or None if it is missing or of another format version.
+        """
+        try:
+            with open(os.path.join(precomputed_dir, MANIFEST_FILE)) as file:
+                manifest = json.load(file)
+        except (OSError, ValueError):
+            return None
+        if manifest.get('version') != PRECOMPUTED_VERSION:
+            return None
+        return cls(precomputed_dir, manifest)
+
+    def recipes(self, user_id, time_tags, top_k, known_user=True):
+        """
+        Returns the precomputed (recipe ids, index labels) for the user in the time context, or None
+        when the time context was not precomputed or top_k is larger than the stored lists.
+        """
+        bucket = self.buckets.get(tuple(time_tags))
+        if bucket is None or top_k > self.top_n:
+            return None
+
+        if known_user:
+            position = np.searchsorted(self.user_ids, user_id)
+            if position >= len(self.user_ids) or self.user_ids[position] != user_id:
+                return None
+            ids, labels = self.recipe_ids[bucket, position], self.recipe_labels[bucket, position]
+        else:
+            ids, labels = self.anonymous_recipe_ids[bucket], self.anonymous_recipe_labels[bucket]
+
+        found = ids >= 0
+        return np.asarray(ids[found][:top_k]), np.asarray(labels[found][:top_k])
+
+    def exercises(self, user_id, top_k, known_user=True):
+        """
+        Returns the precomputed positional exercise rows for the user, or None when top_k is larger than the stored lists.
+        """
+        if top_k > self.top_n:
+            return None
+
+        if known_user:
+            position = np.searchsorted(self.exercise_user_ids, user_id)
+            if position >= len(self.exercise_user_ids) or self.exercise_user_ids[position] != user_id:
+                return None
+            rows = self.exercise_rows[position]
+        else:
+            rows = self.anonymous_exercise_rows
+        return np.asarray(rows[rows >= 0][:top_k])
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Precompute every user's unfiltered recipe recommendations in every time bucket, and their exercise recommendations")
+    parser.add_argument('--precomputed-dir', default=PRECOMPUTED_DIR, help="Directory to write the store to")
+    parser.add_argument('--models-dir', default=MODELS_DIR, help="Directory holding the model artifacts")
+    parser.add_argument('--top-n', type=int, default=PRECOMPUTED_TOP_N, help="Number of recipes to keep per user and bucket, and of exercises per user")
+    parser.add_argument('--workers', type=int, default=None, help="Number of worker processes, defaults to the number of CPUs")
+    parser.add_argument('--compact', action='store_true', help="Load in compact mode")
+    args = parser.parse_args()
+
+    import data_management
+
+    start = time.perf_counter()
+    data = data_management.DataManager(models_dir=args.models_dir, compact=args.compact)
+    manifest = build_precomputed(data, args.precomputed_dir, args.models_dir, top_n=args.top_n, workers=args.workers)
+    print(f"Precomputed {manifest['users']} recipe users in {len(manifest['buckets'])} time buckets and {manifest['exercise_users']} "
+          f"exercise users to {args.precomputed_dir} in {time.perf_counter() - start:.2f}s")
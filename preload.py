@@ -0,0 +1,107 @@
+import logging
+import threading
+import time
+
+import data_management
+from recommend import getRecipesWithConfiguration, getExerciseWithConfiguration
+
+logger = logging.getLogger(__name__)
+
+# Representative query arguments run against a freshly loaded DataManager before it serves requests
+WARM_UP_RECIPE_QUERIES = [
+    {},
+    {'calories': 500},
+    {'tags': ['breakfast']},
+    {'fat': 'low', 'protein': 'high'},
+    {'calories': 800, 'carbs': 'med', 'tags': ['vegetarian']},
+]
+WARM_UP_EXERCISE_QUERIES = [
+    {},
+    {'type': 'Strength'},
+    {'body_part': 'Chest', 'level': 'Beginner'},
+]
+
+def warm_up(data, top_k=5):
+    """
+    Runs the warm-up queries against data, anonymously and for a user the models were trained on, so the
+    first real requests do not pay for cold memory-mapped pages and first-call overheads.
+    """
+    for kind, colab_filter in (('recipe', data.recipe_colab_filter), ('exercise', data.exercise_colab_filter)):
+        users = [(-1, None)]
+        if colab_filter is not None and len(colab_filter.raw_user_ids):
+            users.append((int(colab_filter.raw_user_ids[0]), colab_filter))
+
+        for user_id, user_colab_filter in users:
+            count = data.user_rating_count(kind, user_id)
+            if kind == 'recipe':
+                for query in WARM_UP_RECIPE_QUERIES:
+                    recipes_found = getRecipesWithConfiguration(data.recipes, user_id, count, colab_filter=user_colab_filter,
+                                                                tag_index=data.recipe_tag_index, nutrient_index=data.recipe_nutrient_index,
+                                                                top_k=top_k, **query)
+                    data.recipe_records(recipes_found['id'].tolist())
+            else:
+                for query in WARM_UP_EXERCISE_QUERIES:
+                    getExerciseWithConfiguration(data.exercises, user_id, count, colab_filter=user_colab_filter,
+                                                 exercise_index=data.exercise_index, top_k=top_k, **query).to_dict()
+
+class Preloader:
+    """
+    Loads the DataManager on a background thread, warms it up and only then makes it data_management.data.
+
+    load is called with a progress callback and returns the DataManager. Each load stage is reported as
+    running or done with its duration, so readiness checks can show how far along the load is.
+    """
+    def __init__(self, load) -> None:
+        self.load = load
+        self.state = 'pending'
+        self.stages = {}
+        self.error = None
+        self.started_at = None
+        self.ready_at = None
+        self.lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def ready(self):
+        return self.state == 'ready'
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self.run, name="data-preload", daemon=True)
+            self._thread.start()
+
+    def progress(self, stage, seconds=None):
+        with self.lock:
+            self.stages[stage] = {'state': 'running' if seconds is None else 'done',
+                                  'seconds': None if seconds is None else round(seconds, 3)}
+
+    def run(self):
+        self.started_at = time.time()
+        self.state = 'loading'
+        try:
+            data = self.load(self.progress)
+
+            self.state = 'warming_up'
+            self.progress('warm_up')
+            start = time.perf_counter()
+            warm_up(data)
+            self.progress('warm_up', time.perf_counter() - start)
+
+            data_management.data = data
+            self.ready_at = time.time()
+            self.state = 'ready'
+            logger.info("Data ready in %.2fs", self.ready_at - self.started_at)
+        except Exception as error:
+            self.error = str(error)
+            self.state = 'failed'
+            logger.exception("Loading the data failed")
+
+    def status(self):
+        with self.lock:
+            stages = {stage: dict(stage_status) for stage, stage_status in self.stages.items()}
+        return {
+            'state': self.state,
+            'stages': stages,
+            'error': self.error,
+            'seconds': ((self.ready_at or time.time()) - self.started_at) if self.started_at else None,
+        }
@@ -0,0 +1,31 @@
+import os
+import shutil
+from contextlib import contextmanager
+
+@contextmanager
+def staged_dir(target_dir):
+    """
+    Yields a staging directory next to target_dir to write a store into, and moves it into place as
+    target_dir once the block finishes, so readers never see a partly written store.
+
+    A previous target_dir is replaced. If the block fails, the staging directory is removed and target_dir is left as it was.
+    """
+    staging_dir = f"{target_dir.rstrip(os.sep)}.building-{os.getpid()}"
+    shutil.rmtree(staging_dir, ignore_errors=True)
+    os.makedirs(staging_dir)
+    try:
+        yield staging_dir
+    except BaseException:
+        shutil.rmtree(staging_dir, ignore_errors=True)
+        raise
+    shutil.rmtree(target_dir, ignore_errors=True)
+    os.replace(staging_dir, target_dir)
+
+def write_pointer(path, value):
+    """
+    Writes a file naming the current version of a store, such as CURRENT or GENERATION, replacing the old one in one step.
+    """
+    temporary_path = f"{path}.{os.getpid()}.tmp"
+    with open(temporary_path, 'w') as file:
+        file.write(str(value))
+    os.replace(temporary_path, path)
@@ -1,10 +1,20 @@
+import re
 import pandas as pd
 import numpy as np
+from indexes import TAG_MATCH_EXACT, NUTRIENT_COLUMNS, EXERCISE_FILTER_COLUMNS
+from metrics import STAGE_SECONDS, CANDIDATES
 
 DVP_HIGH = 40.0
 DVP_MED = 25.0
 DVP_LOW = 10.0
 
+# Largest (users x candidates) score matrix getRecipesForUsers builds at once
+BATCH_SCORE_ELEMENTS = 1 << 22
+
+# Exercise ratings in Data/Exercises.csv are out of 10, user ratings are out of 5
+EXERCISE_RATING_MAX = 10.0
+USER_RATING_MAX = 5.0
+
 def parse_pdv(dvp, multiplier):
     low = 0.0
     high = float("inf")
@@ -18,8 +28,63 @@ def parse_pdv(dvp, multiplier):
             high = DVP_MED * multiplier
     return low, high
 
-def getRecipesWithConfiguration(recipes, user_id, user_ratings_count, colab_filter=None, calories=None, daily=2000, fat="NULL", sat_fat="NULL", sugar="NULL", sodium="NULL", protein="NULL", carbs="NULL", tags=[]):
-    
+def getRecipesWithConfiguration(recipes, user_id, user_ratings_count, colab_filter=None, calories=None, daily=2000, fat="NULL", sat_fat="NULL", sugar="NULL", sodium="NULL", protein="NULL", carbs="NULL", tags=[], tag_index=None, tag_match=TAG_MATCH_EXACT, nutrient_index=None, top_k=None):
+    candidate_rows = get_candidate_rows(recipes, calories=calories, daily=daily, fat=fat, sat_fat=sat_fat, sugar=sugar, sodium=sodium,
+                                        protein=protein, carbs=carbs, tags=tags, tag_index=tag_index, tag_match=tag_match,
+                                        nutrient_index=nutrient_index)
+
+    with STAGE_SECONDS.time('colab_predict'):
+        if colab_filter:
+            colab_predictions = predict_colab_batch(colab_filter, user_id, recipes['id'].values[candidate_rows])
+            candidate_scores = calculate_weighted_prediction(recipes['bayesian_avg'].values[candidate_rows], colab_predictions, user_ratings_count)
+        else:
+            candidate_scores = recipes['bayesian_avg'].values[candidate_rows]
+
+    with STAGE_SECONDS.time('time_context'):
+        time_tag_masks = get_time_tag_masks(recipes, tags, tag_index=tag_index, tag_match=tag_match)
+        return rank_recipes(recipes, candidate_rows, candidate_scores, time_tag_masks, tags, top_k=top_k)
+
+def getRecipesForUsers(recipes, users, colab_filter=None, calories=None, daily=2000, fat="NULL", sat_fat="NULL", sugar="NULL", sodium="NULL", protein="NULL", carbs="NULL", tags=[], tag_index=None, tag_match=TAG_MATCH_EXACT, nutrient_index=None, top_k=None, time_tags=None):
+    """
+    Batch version of getRecipesWithConfiguration for many users sharing the same filters.
+
+    The candidates are computed once, and the users are scored together with one
+    (users x factors) . (factors x candidates) product per chunk of users, which keeps the score
+    matrix within BATCH_SCORE_ELEMENTS entries. Users the model does not know are ranked on the
+    Bayesian average alone, as getRecipesWithConfiguration does without a colab_filter.
+
+    Args:
+        users (list): (user_id, user_ratings_count) of each user.
+        time_tags (list): Time context to rank for instead of the current one from get_time_tags.
+
+    Returns:
+        list: The recommended recipes for each user, in the order of users.
+    """
+    candidate_rows = get_candidate_rows(recipes, calories=calories, daily=daily, fat=fat, sat_fat=sat_fat, sugar=sugar, sodium=sodium,
+                                        protein=protein, carbs=carbs, tags=tags, tag_index=tag_index, tag_match=tag_match,
+                                        nutrient_index=nutrient_index)
+    bayesian_scores = recipes['bayesian_avg'].values[candidate_rows]
+
+    colab_users = [position for position, (user_id, _) in enumerate(users) if colab_filter and colab_filter.knows_user(user_id)]
+    scores = {}
+    chunk_size = max(1, BATCH_SCORE_ELEMENTS // max(1, len(candidate_rows)))
+    with STAGE_SECONDS.time('colab_predict_batch'):
+        for chunk_start in range(0, len(colab_users), chunk_size):
+            chunk = colab_users[chunk_start:chunk_start + chunk_size]
+            colab_predictions = predict_colab_matrix(colab_filter, [users[position][0] for position in chunk], recipes['id'].values[candidate_rows])
+            counts = np.array([users[position][1] for position in chunk], dtype=float)[:, None]
+            for position, user_scores in zip(chunk, calculate_weighted_prediction(bayesian_scores[None, :], colab_predictions, counts)):
+                scores[position] = user_scores
+
+    with STAGE_SECONDS.time('time_context_batch'):
+        time_tag_masks = get_time_tag_masks(recipes, tags, tag_index=tag_index, tag_match=tag_match, time_tags=time_tags)
+        return [rank_recipes(recipes, candidate_rows, scores.get(position, bayesian_scores), time_tag_masks, tags, top_k=top_k)
+                for position in range(len(users))]
+
+def get_candidate_rows(recipes, calories=None, daily=2000, fat="NULL", sat_fat="NULL", sugar="NULL", sodium="NULL", protein="NULL", carbs="NULL", tags=[], tag_index=None, tag_match=TAG_MATCH_EXACT, nutrient_index=None):
+    """
+    Returns the positional rows of the recipes matching the calorie, nutrient and tag filters.
+    """
     high_calorie_lim = float("inf")
     low_calorie_lim = 0
 
@@ -29,69 +94,146 @@ def getRecipesWithConfiguration(recipes, user_id, user_ratings_count, colab_filt
         high_calorie_lim = max(calories+100, calories * 1.1)
         low_calorie_lim = min(calories-100, calories * 0.9)        
     
-    low_fat_lim, high_fat_lim = parse_pdv(fat, multiplier)
-    low_sat_fat_lim, high_sat_fat_lim = parse_pdv(sat_fat, multiplier)
-    low_sugar_lim, high_sugar_lim = parse_pdv(sugar, multiplier)
-    low_sodium_lim, high_sodium_lim = parse_pdv(sodium, multiplier)
-    low_protein_lim, high_protein_lim = parse_pdv(protein, multiplier)
-    low_carbs_lim, high_carbs_lim = parse_pdv(carbs, multiplier)
-
-    recipes_filter = ((low_calorie_lim <= recipes['calories']) & (recipes['calories'] <= high_calorie_lim) &
-                      (low_fat_lim <= recipes['total fat (PDV)']) & (recipes['total fat (PDV)'] <= high_fat_lim) &
-                      (low_sat_fat_lim <= recipes['saturated fat (PDV)']) & (recipes['saturated fat (PDV)'] <= high_sat_fat_lim) &
-                      (low_sugar_lim <= recipes['sugar (PDV)']) & (recipes['sugar (PDV)'] <= high_sugar_lim) &
-                      (low_sodium_lim <= recipes['sodium (PDV)']) & (recipes['sodium (PDV)'] <= high_sodium_lim) &
-                      (low_protein_lim <= recipes['protein (PDV)']) & (recipes['protein (PDV)'] <= high_protein_lim) &
-                      (low_carbs_lim <= recipes['carbohydrates (PDV)']) & (recipes['carbohydrates (PDV)'] <= high_carbs_lim))
+    nutrient_limits = {
+        'calories': (low_calorie_lim, high_calorie_lim),
+        'total fat (PDV)': parse_pdv(fat, multiplier),
+        'saturated fat (PDV)': parse_pdv(sat_fat, multiplier),
+        'sugar (PDV)': parse_pdv(sugar, multiplier),
+        'sodium (PDV)': parse_pdv(sodium, multiplier),
+        'protein (PDV)': parse_pdv(protein, multiplier),
+        'carbohydrates (PDV)': parse_pdv(carbs, multiplier),
+    }
 
-    tags_filter = pd.Series(True, index=recipes.index)
+    with STAGE_SECONDS.time('nutrient_filter'):
+        if nutrient_index is not None:
+            recipes_filter = nutrient_index.mask(nutrient_limits)
+        else:
+            # Compared in float32 like NutrientIndex does, so both paths agree on recipes at a limit
+            recipes_filter = pd.Series(True, index=recipes.index)
+            for column in NUTRIENT_COLUMNS:
+                low, high = np.float32(nutrient_limits[column][0]), np.float32(nutrient_limits[column][1])
+                values = recipes[column].astype(np.float32)
+                recipes_filter = recipes_filter & (low <= values) & (values <= high)
+        recipes_filter = np.asarray(recipes_filter, dtype=bool)
 
     if tags:
-        for tag in tags:
-            if type(tag) != str:
-                continue
+        CANDIDATES.observe(np.count_nonzero(recipes_filter), 'nutrient_filter')
+        with STAGE_SECONDS.time('tag_filter'):
+            recipes_filter = recipes_filter & get_tags_mask(recipes, tags, tag_index=tag_index, tag_match=tag_match)
+
+    candidate_rows = np.flatnonzero(recipes_filter)
+    CANDIDATES.observe(len(candidate_rows), 'candidates')
+    return candidate_rows
+
+def get_time_tag_masks(recipes, tags, tag_index=None, tag_match=TAG_MATCH_EXACT, time_tags=None):
+    return {tag: get_tags_mask(recipes, [tag], tag_index=tag_index, tag_match=tag_match)
+            for tag in (get_time_tags() if time_tags is None else time_tags) if tag not in tags}
+
+def rank_recipes(recipes, candidate_rows, candidate_scores, time_tag_masks, tags, top_k=None):
+    """
+    Returns the top_k scored candidates as a frame, boosted by the time context when there is one.
+    """
+    if not time_tag_masks:
+        return recipes.iloc[top_rows(candidate_rows, candidate_scores, top_k)]
+
+    ranked_rows, labels = rank_with_time_context(candidate_rows, candidate_scores, time_tag_masks, tags, top_k=top_k)
+    recipes_found_sorted = recipes.iloc[ranked_rows]
+    recipes_found_sorted.index = labels
+    return recipes_found_sorted
+
+def get_tags_mask(recipes, tags, tag_index=None, tag_match=TAG_MATCH_EXACT):
+    """
+    Returns a boolean row mask of the recipes that carry every tag in tags.
+
+    Uses the precomputed tag index when given, otherwise scans the tags column.
+    """
+    if tag_index is not None:
+        return tag_index.mask(tags, match=tag_match)
+
+    tags_filter = pd.Series(True, index=recipes.index)
+    for tag in tags:
+        if type(tag) != str:
+            continue
+        if tag_match == TAG_MATCH_EXACT:
+            tags_filter = tags_filter & recipes['tags'].str.contains(f"'{re.escape(tag)}'", case=False)
+        else:
             tags_filter = tags_filter & recipes['tags'].str.contains(tag, case=False)
+    return tags_filter.to_numpy(dtype=bool)
 
-        recipes_filter = recipes_filter & tags_filter
-    
-    recipes_found = recipes[recipes_filter]
-    recipes_found_sorted = recipes_found.sort_values(by='bayesian_avg', ascending=False)
+def top_rows(rows, scores, k=None):
+    """
+    Returns rows ordered by descending score, keeping only the best k when k is given.
 
-    if colab_filter:
-        recipe_ids = recipes_found['id'].tolist()
-        weighted_predictions = []
-        for recipe_id in recipe_ids:
-            bayesian_avg = recipes_found[recipes_found['id'] == recipe_id]['bayesian_avg'].values[0]
-            colab_prediction = colab_filter.predict(user_id, recipe_id)
-            
-            weighted_predictions.append((recipe_id, calculate_weighted_prediction(bayesian_avg, colab_prediction.est, user_ratings_count)))
-        predictions_sorted = sorted(weighted_predictions, key=lambda x: x[1], reverse=True)
-        sorted_recipe_ids = [pred[0] for pred in predictions_sorted]
-        recipes_found_sorted = recipes_found_sorted.reindex(sorted_recipe_ids)
-    
-    
-    time_tags = get_time_tags()
+    Uses a partial selection instead of a full sort when k is smaller than the number of rows. Ties are
+    ordered as a stable sort would order them.
+
+    Args:
+        rows (np.ndarray): Positional rows.
+        scores (np.ndarray): Score of each row.
+        k (int): Number of rows to keep, or None to rank every row.
+
+    Returns:
+        np.ndarray: The selected rows in ranked order.
+    """
+    negated_scores = -np.asarray(scores, dtype=float)
+    if k is None or k >= len(rows):
+        return rows[np.argsort(negated_scores, kind='stable')]
+    if k <= 0:
+        return rows[:0]
+
+    kth_score = np.partition(negated_scores, k - 1)[k - 1]
+    if np.isnan(kth_score):
+        return rows[np.argsort(negated_scores, kind='stable')[:k]]
+
+    selected = np.flatnonzero(negated_scores <= kth_score)
+    selected = selected[np.argsort(negated_scores[selected], kind='stable')[:k]]
+    return rows[selected]
+
+def rank_with_time_context(rows, scores, time_tag_masks, tags, top_k=None):
+    """
+    Ranks scored candidates, boosting the best recipes matching the current time context to the top.
+
+    For every time tag not yet in tags, the candidates carrying that tag are ranked with the remaining
+    time tags in the same way, and the top two of those contexts are moved to the front. Since the
+    candidates are already scored, this only intersects them with the time tag masks.
+
+    Args:
+        rows (np.ndarray): Positional recipe rows of the candidates.
+        scores (np.ndarray): Score of each candidate.
+        time_tag_masks (dict): Maps each time tag to its boolean row mask over the recipes.
+        tags (list): Tags already required of the candidates.
+        top_k (int): Number of rows to return, or None to rank every candidate.
+
+    Returns:
+        tuple: Positional recipe rows in ranked order without duplicates, and the position of each row in the
+        boosted list before duplicates were dropped, which is used as the result's index.
+    """
     recipes_with_time_context = []
-    for tag in time_tags:
+    for tag, tag_mask in time_tag_masks.items():
         if tag in tags:
             continue
-        recp = getRecipesWithConfiguration(recipes, user_id, user_ratings_count, colab_filter=colab_filter, calories=calories, daily=daily, fat=fat, sat_fat=sat_fat, sugar=sugar, sodium=sodium, protein=protein, carbs=carbs, tags=tags + [tag])
-        if not(type(recp) == bool and recp == False):
-            recipes_with_time_context.append(recp[:5])
+        tagged = tag_mask[rows]
+        recipes_with_time_context.append(rank_with_time_context(rows[tagged], scores[tagged], time_tag_masks, tags + [tag], top_k=5)[0])
+
+    # Up to two boosted rows can be dropped as duplicates, so two extra ranked rows cover top_k.
+    ranked_rows = top_rows(rows, scores, None if top_k is None else top_k + 2)
 
     if recipes_with_time_context == []:
-        return recipes_found_sorted
-    
-    recipes_with_time_context = pd.concat(recipes_with_time_context, ignore_index=True)
-    recipes_found_sorted = pd.concat([recipes_with_time_context[:2], recipes_found_sorted], ignore_index=True).drop_duplicates()
+        ranked_rows = ranked_rows[:top_k]
+        return ranked_rows, np.arange(len(ranked_rows))
 
-    return recipes_found_sorted
+    recipes_with_time_context = np.concatenate(recipes_with_time_context)
+    ranked_rows = np.concatenate([recipes_with_time_context[:2], ranked_rows])
+    _, first_occurrences = np.unique(ranked_rows, return_index=True)
+    first_occurrences = np.sort(first_occurrences)[:top_k]
+    return ranked_rows[first_occurrences], first_occurrences
 
-def get_time_tags():
+def get_time_tags(now=None):
     from datetime import datetime
     tags = []
+    now = now or datetime.today()
 
-    month = int(datetime.today().strftime("%m"))
+    month = int(now.strftime("%m"))
     if 3 <= month <= 5:
         tags.append('spring')
     elif 6 <= month <= 8:
@@ -101,42 +243,104 @@ def get_time_tags():
     else:
         tags.append('winter')
 
-    hour_of_day = int(datetime.today().strftime("%H"))
+    hour_of_day = int(now.strftime("%H"))
     if 5 <= hour_of_day <= 12:
         tags.append('breakfast')
     if 11 <= hour_of_day <= 4:
         tags.append('lunch')
     return tags
 
-def getExerciseWithConfiguration(exercises, user_id, user_ratings_count, colab_filter=None, type=None, body_part=None, equipment=None, level=None):
-    conditions = []
-    if not (type is None):
-        conditions.append(f"Type == '{type}'")
-    if not (body_part is None):
-        conditions.append(f"BodyPart == '{body_part}'")
-    if not (equipment is None):
-        conditions.append(f"Equipment == '{equipment}'")
-    if not (level is None):
-        conditions.append(f"Level == '{level}'")
-
-    query_string = " and ".join(conditions)
-
-    if query_string:
-        exercises_found = exercises.query(query_string).sort_values(by='Rating', ascending=False)
-        if exercises_found:
-            if colab_filter:
-                exercise_ids = exercises_found['id'].tolist()
-                weighted_predictions = []
-                for exercise_id in exercise_ids:
-                    colab_prediction = colab_filter.predict(user_id, exercise_id)
-                    weighted_predictions.append((exercise_id, calculate_weighted_prediction(colab_prediction, user_ratings_count)))
-                weighted_predictions = sorted(weighted_predictions, key=lambda x: x[1], reverse=True)
-                sorted_exercise_ids = [pred[0] for pred in weighted_predictions]
-                exercises_found = exercises_found.reindex(sorted_exercise_ids)
-            
-            return exercises_found
-            
-    return exercises
+def filter_exercise_rows(exercises, exercise_index=None, type=None, body_part=None, equipment=None, level=None):
+    """
+    Returns the positional rows of the exercises matching every filter that is not None, sorted by descending Rating.
+    """
+    if exercise_index is not None:
+        return exercise_index.rows(type=type, body_part=body_part, equipment=equipment, level=level)
+
+    exercises_filter = np.ones(len(exercises), dtype=bool)
+    for column, value in zip(EXERCISE_FILTER_COLUMNS, (type, body_part, equipment, level)):
+        if value is not None:
+            exercises_filter &= (exercises[column] == value).to_numpy()
+    candidate_rows = np.flatnonzero(exercises_filter)
+    return top_rows(candidate_rows, exercises['Rating'].values[candidate_rows])
+
+def getExerciseWithConfiguration(exercises, user_id, user_ratings_count, colab_filter=None, type=None, body_part=None, equipment=None, level=None, top_k=None, exercise_index=None):
+    with STAGE_SECONDS.time('exercise_filter'):
+        exercise_rows = filter_exercise_rows(exercises, exercise_index, type=type, body_part=body_part, equipment=equipment, level=level)
+        if len(exercise_rows) == 0:
+            # Nothing matches the filters, so every exercise is ranked instead
+            exercise_rows = filter_exercise_rows(exercises, exercise_index)
+    CANDIDATES.observe(len(exercise_rows), 'exercise_candidates')
+
+    if colab_filter:
+        with STAGE_SECONDS.time('exercise_colab_predict'):
+            colab_predictions = predict_colab_batch(colab_filter, user_id, exercises['id'].values[exercise_rows])
+            exercise_ratings = exercises['Rating'].values[exercise_rows] * (USER_RATING_MAX / EXERCISE_RATING_MAX)
+            weighted_predictions = calculate_weighted_prediction(exercise_ratings, colab_predictions, user_ratings_count)
+            exercise_rows = top_rows(exercise_rows, weighted_predictions, top_k)
+
+    return exercises.iloc[exercise_rows[:top_k]]
+
+def predict_colab_batch(colab_filter, user_id, item_ids):
+    """
+    Vectorized equivalent of calling SVD.predict(user_id, item_id).est for every item.
+
+    Reads the model's factors and biases once and scores all items with a single
+    matrix-vector product, following the same unknown user/item and clipping rules as Surprise.
+
+    Args:
+        colab_filter (FactorModel): Trained factor model.
+        user_id: Raw id of the user.
+        item_ids (array-like): Raw ids of the items to score.
+
+    Returns:
+        np.ndarray: Estimated rating for each item.
+    """
+    inner_iids = colab_filter.inner_item_ids(item_ids)
+    known_items = inner_iids >= 0
+    user_factors = colab_filter.user_factors(user_id)
+
+    estimates = np.full(len(inner_iids), colab_filter.global_mean, dtype=float)
+
+    if colab_filter.biased:
+        if user_factors is not None:
+            estimates += user_factors[0]
+        estimates[known_items] += colab_filter.bi[inner_iids[known_items]]
+        if user_factors is not None:
+            estimates[known_items] += colab_filter.qi[inner_iids[known_items]] @ user_factors[1]
+    elif user_factors is not None:
+        estimates[known_items] = colab_filter.qi[inner_iids[known_items]] @ user_factors[1]
+
+    lower_bound, higher_bound = colab_filter.rating_scale
+    return np.clip(estimates, lower_bound, higher_bound)
+
+def predict_colab_matrix(colab_filter, user_ids, item_ids):
+    """
+    Estimated ratings of several users for the same items, as predict_colab_batch would give for each user.
+
+    Returns:
+        np.ndarray: A (users x items) array of estimated ratings, computed with one matrix product.
+    """
+    inner_iids = colab_filter.inner_item_ids(item_ids)
+    known_items = inner_iids >= 0
+    user_factors = [colab_filter.user_factors(user_id) for user_id in user_ids]
+    known_users = np.array([factors is not None for factors in user_factors], dtype=bool)
+
+    n_factors = colab_filter.qi.shape[1]
+    bu = np.array([factors[0] if factors is not None else 0.0 for factors in user_factors], dtype=float)
+    pu = np.array([factors[1] if factors is not None else np.zeros(n_factors) for factors in user_factors], dtype=float).reshape(len(user_ids), n_factors)
+
+    estimates = np.full((len(user_ids), len(inner_iids)), colab_filter.global_mean, dtype=float)
+    item_factors = colab_filter.qi[inner_iids[known_items]]
+    if colab_filter.biased:
+        estimates += bu[:, None]
+        estimates[:, known_items] += colab_filter.bi[inner_iids[known_items]]
+        estimates[:, known_items] += pu @ item_factors.T
+    elif known_users.any():
+        estimates[np.ix_(known_users, known_items)] = pu[known_users] @ item_factors.T
+
+    lower_bound, higher_bound = colab_filter.rating_scale
+    return np.clip(estimates, lower_bound, higher_bound)
 
 def sigmoid(x, k=1, x0=0):
     return 1 / (1 + np.exp(-k*(x-x0)))
@@ -0,0 +1,154 @@
+import fcntl
+import logging
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import data_management
+from metrics import MODEL_SECONDS
+from model_store import MODELS_DIR, current_version, train_and_publish
+from preload import warm_up
+from shared_data import current_generation, publish_data
+
+logger = logging.getLogger(__name__)
+
+class RetrainScheduler:
+    """
+    Background worker that retrains the models and swaps in a fresh DataManager.
+
+    A retrain starts once the rating databases have grown by threshold ratings since the current
+    DataManager was loaded, or once interval seconds have passed. Training runs in a separate process
+    and publishes new model artifacts. A new DataManager is then built from the snapshot and the
+    published artifacts on this thread, warmed up, and swapped in with a single reference assignment,
+    so requests already holding the old one finish on it. Ratings recorded since the old one was loaded
+    are replayed into the new one as it is swapped in, and later ones are passed on to it.
+
+    When several workers share models_dir, a file lock lets only one of them train; the others pick
+    up the newly published versions on their next poll.
+
+    A worker attached to a shared data store (see shared_data) never retrains. It reattaches to
+    shared_dir once the loader has published a new generation there. The loader runs the scheduler
+    with publish_dir, so every swapped-in DataManager is published as the next generation.
+    """
+    def __init__(self, models_dir=MODELS_DIR, threshold=1000, interval=24 * 60 * 60, poll_interval=60, shared_dir=None, publish_dir=None) -> None:
+        self.models_dir = models_dir
+        self.shared_dir = shared_dir
+        self.publish_dir = publish_dir
+        self.threshold = threshold
+        self.interval = interval
+        self.poll_interval = poll_interval
+        self.retrains = 0
+        self.swaps = 0
+        self.failures = 0
+        self.last_retrain_seconds = None
+        self.last_swap_seconds = None
+        self.last_swap_at = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self.run, name="retrain-scheduler", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def run(self):
+        while not self._stop.wait(self.poll_interval):
+            try:
+                self.run_once()
+            except Exception:
+                self.failures += 1
+                logger.exception("Retraining failed")
+
+    def pending_ratings(self, data):
+        counts = data_management.count_db_ratings()
+        return sum(counts[kind] - data.db_rating_counts[kind] for kind in counts)
+
+    def published_newer_model(self, data):
+        return any(current_version(kind, self.models_dir) not in (None, version) for kind, version in data.model_versions.items())
+
+    def run_once(self):
+        data = data_management.data
+        if data is None:
+            return
+
+        if data.shared_generation is not None:
+            if current_generation(self.shared_dir) not in (None, data.shared_generation):
+                self.swap()
+        elif self.published_newer_model(data):
+            self.swap()
+        elif self.pending_ratings(data) >= self.threshold or time.time() - data.loaded_at >= self.interval:
+            if self.retrain():
+                self.swap()
+
+    def retrain(self):
+        os.makedirs(self.models_dir, exist_ok=True)
+        with open(os.path.join(self.models_dir, ".retrain.lock"), 'w') as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return False
+
+            start = time.perf_counter()
+            with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as pool:
+                versions = pool.submit(train_and_publish, self.models_dir).result()
+            self.last_retrain_seconds = time.perf_counter() - start
+            MODEL_SECONDS.observe(self.last_retrain_seconds, 'retrain')
+            self.retrains += 1
+            logger.info("Retrained models %s in %.2fs", versions, self.last_retrain_seconds)
+            return True
+
+    def swap(self):
+        start = time.perf_counter()
+        previous = data_management.data
+        if previous is None:
+            data = data_management.DataManager(models_dir=self.models_dir, shared_dir=self.shared_dir)
+        else:
+            data = data_management.DataManager(snapshot_dir=previous.snapshot_dir, models_dir=self.models_dir, compact=previous.compact,
+                                               shared_dir=self.shared_dir)
+        warm_up(data)
+        # Requests still holding previous may record ratings after the swap, and previous passes those on to data
+        with data_management.ratings_lock:
+            if previous is not None:
+                data.replay_ratings(previous)
+                previous.successor = data
+            data_management.data = data
+        if self.publish_dir:
+            publish_data(data, self.publish_dir, self.models_dir)
+
+        self.last_swap_seconds = time.perf_counter() - start
+        MODEL_SECONDS.observe(self.last_swap_seconds, 'swap')
+        self.last_swap_at = time.time()
+        self.swaps += 1
+        logger.info("Swapped in DataManager with models %s in %.2fs", data.model_versions, self.last_swap_seconds)
+
+    def status(self):
+        data = data_management.data
+        models = {}
+        if data is not None:
+            for kind, colab_filter in (('recipe', data.recipe_colab_filter), ('exercise', data.exercise_colab_filter)):
+                trained_at = colab_filter.metadata.get('trained_at') if colab_filter else None
+                models[kind] = {
+                    'version': data.model_versions[kind],
+                    'trained_at': trained_at,
+                    'staleness_seconds': time.time() - time.mktime(time.strptime(trained_at, '%Y-%m-%dT%H:%M:%S')) if trained_at else None,
+                }
+
+        return {
+            'models': models,
+            'data_age_seconds': time.time() - data.loaded_at if data is not None else None,
+            'shared_generation': data.shared_generation if data is not None else None,
+            'retrains': self.retrains,
+            'swaps': self.swaps,
+            'failures': self.failures,
+            'last_retrain_seconds': self.last_retrain_seconds,
+            'last_swap_seconds': self.last_swap_seconds,
+            'last_swap_at': self.last_swap_at,
+        }
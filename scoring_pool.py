@@ -0,0 +1,79 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+class PoolSaturated(Exception):
+    pass
+
+class BoundedPool:
+    """
+    Thread pool that admits at most max_pending calls at a time, running or queued, for use from an event loop.
+
+    Calls beyond that are rejected right away with PoolSaturated instead of queueing without bound, and a call
+    that takes longer than timeout seconds raises asyncio.TimeoutError in the caller. A call that timed out
+    before a thread picked it up is dropped; one that was already running finishes in the background and holds
+    its slot until then, so the pool never runs more work than it admits.
+    """
+    def __init__(self, name, max_workers, max_pending, timeout=None) -> None:
+        self.name = name
+        self.max_workers = max_workers
+        self.max_pending = max(max_pending, max_workers)
+        self.timeout = timeout
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name)
+        self.pending = 0
+        self.submitted = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self.completed = 0
+        self.total_seconds = 0.0
+        self.max_seconds = None
+        self.lock = threading.Lock()
+
+    async def run(self, fn, *args):
+        """
+        Runs fn(*args) on the pool and returns its result.
+        """
+        with self.lock:
+            if self.pending >= self.max_pending:
+                self.rejected += 1
+                raise PoolSaturated(f"{self.name} pool has {self.pending} calls pending")
+            self.pending += 1
+            self.submitted += 1
+
+        start = time.perf_counter()
+        future = self.executor.submit(fn, *args)
+        future.add_done_callback(lambda future: self.release(future, start))
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(future), self.timeout)
+        except asyncio.TimeoutError:
+            with self.lock:
+                self.timed_out += 1
+            raise
+
+    def release(self, future, start):
+        seconds = time.perf_counter() - start
+        with self.lock:
+            self.pending -= 1
+            if not future.cancelled():
+                self.completed += 1
+                self.total_seconds += seconds
+                self.max_seconds = max(self.max_seconds or 0, seconds)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'workers': self.max_workers,
+                'max_pending': self.max_pending,
+                'timeout_seconds': self.timeout,
+                'pending': self.pending,
+                'submitted': self.submitted,
+                'rejected': self.rejected,
+                'timed_out': self.timed_out,
+                'completed': self.completed,
+                'avg_seconds': self.total_seconds / self.completed if self.completed else None,
+                'max_seconds': self.max_seconds,
+            }
@@ -0,0 +1,188 @@
+import argparse
+import json
+import os
+import shutil
+import time
+
+import numpy as np
+import pandas as pd
+
+from model_store import MODELS_DIR, publish_trained
+from publishing import staged_dir, write_pointer
+from snapshot import read_column, write_column
+
+SHARED_DIR = "Data/shared"
+GENERATION_FILE = "GENERATION"
+MANIFEST_FILE = "manifest.json"
+SHARED_VERSION = 1
+
+# DataManager frames published to the shared store
+SHARED_FRAMES = ['recipes', 'user_interactions', 'exercises', 'exercise_ratings']
+
+# Id and rating columns published as integers, so workers memory-map them instead of getting string columns
+SHARED_INTEGER_COLUMNS = {
+    'recipes': ['id'],
+    'user_interactions': ['user_id', 'id', 'rating'],
+    'exercises': ['id'],
+    'exercise_ratings': ['user_id', 'exercise_id', 'rating'],
+}
+
+def integer_column(frame_name, column, values):
+    """
+    Returns an id or rating column as integers, casting one that lost its dtype, e.g. read from an empty table, to int64.
+    """
+    if np.issubdtype(values.dtype, np.integer):
+        return values
+    try:
+        return values.astype(np.int64)
+    except (TypeError, ValueError) as error:
+        raise ValueError(f"Cannot publish {frame_name}.{column}: expected integers, got {values.dtype}") from error
+
+def current_generation(shared_dir=SHARED_DIR):
+    """
+    Returns the generation currently published in shared_dir, or None if nothing has been published.
+    """
+    try:
+        with open(os.path.join(shared_dir, GENERATION_FILE)) as file:
+            return int(file.read().strip())
+    except (OSError, ValueError):
+        return None
+
+def index_arrays(data):
+    """
+    Returns the derived arrays of a DataManager that are published alongside its frames.
+    """
+    arrays = {'tag_bitmaps': np.stack(list(data.recipe_tag_index.bitmaps.values())) if data.recipe_tag_index.bitmaps
+              else np.zeros((0, (data.recipe_tag_index.size + 7) // 8), dtype=np.uint8)}
+    for position, column in enumerate(data.recipe_nutrient_index.values):
+        arrays[f'nutrient_{position}_values'] = data.recipe_nutrient_index.values[column]
+        arrays[f'nutrient_{position}_order'] = data.recipe_nutrient_index.order[column]
+        arrays[f'nutrient_{position}_sorted_values'] = data.recipe_nutrient_index.sorted_values[column]
+    arrays['recipe_id_index_values'] = integer_column('recipes', 'id', np.asarray(data.recipe_id_index[0]))
+    arrays['recipe_id_index_order'] = data.recipe_id_index[1]
+    for kind, (values, order) in data.user_rating_index.items():
+        arrays[f'{kind}_user_rating_index_values'] = integer_column(kind, 'user_id', np.asarray(values))
+        arrays[f'{kind}_user_rating_index_order'] = order
+    return arrays
+
+def publish_data(data, shared_dir=SHARED_DIR, models_dir=MODELS_DIR, keep=2):
+    """
+    Writes a loaded DataManager to shared_dir as the next generation, for worker processes to attach to.
+
+    Numeric columns and index arrays are written as .npy files that workers memory-map read-only, so
+    every worker shares the same pages. Models the DataManager trained itself are published to models_dir
+    first, so workers map the same factor matrices too. Older generations beyond keep are removed.
+
+    Returns:
+        int: The published generation.
+    """
+    generation = (current_generation(shared_dir) or 0) + 1
+    generation_dir = os.path.join(shared_dir, f"{generation:06d}")
+
+    publish_trained({'recipe': data.recipe_colab_filter, 'exercise': data.exercise_colab_filter}, models_dir)
+
+    manifest = {
+        'version': SHARED_VERSION,
+        'generation': generation,
+        'published_at': time.time(),
+        'loaded_at': data.loaded_at,
+        'snapshot_dir': data.snapshot_dir,
+        'models_dir': models_dir,
+        'compact': data.compact,
+        'lazy_columns': data.lazy_columns,
+        'source_columns': data.source_columns,
+        'model_versions': data.model_versions,
+        'db_rating_counts': data.db_rating_counts,
+        'tags': list(data.recipe_tag_index.bitmaps),
+        'nutrient_columns': list(data.recipe_nutrient_index.values),
+        'frames': {},
+        'arrays': [],
+    }
+    with staged_dir(generation_dir) as staging_dir:
+        for name in SHARED_FRAMES:
+            frame = getattr(data, name)
+            frame = frame.assign(**{column: integer_column(name, column, frame[column]) for column in SHARED_INTEGER_COLUMNS[name]})
+            frame_dir = os.path.join(staging_dir, name)
+            os.makedirs(frame_dir)
+            manifest['frames'][name] = {
+                'rows': len(frame),
+                'columns': [write_column(frame_dir, position, frame[column]) for position, column in enumerate(frame.columns)],
+            }
+        for name, array in index_arrays(data).items():
+            array = np.asarray(array)
+            if array.dtype == object:
+                raise ValueError(f"Cannot publish {name}: arrays of Python objects cannot be memory-mapped")
+            np.save(os.path.join(staging_dir, f"{name}.npy"), array)
+            manifest['arrays'].append(name)
+
+        with open(os.path.join(staging_dir, MANIFEST_FILE), 'w') as file:
+            json.dump(manifest, file, indent=2)
+    write_pointer(os.path.join(shared_dir, GENERATION_FILE), generation)
+
+    # Workers still attached to a removed generation keep their mappings until they reattach
+    for old_generation in range(generation - keep, 0, -1):
+        old_dir = os.path.join(shared_dir, f"{old_generation:06d}")
+        if not os.path.isdir(old_dir):
+            break
+        shutil.rmtree(old_dir, ignore_errors=True)
+    return generation
+
+class SharedData:
+    """
+    One published generation of the shared data store, with its arrays memory-mapped read-only.
+    """
+    def __init__(self, generation_dir, manifest) -> None:
+        self.generation_dir = generation_dir
+        self.manifest = manifest
+        self.generation = manifest['generation']
+
+    @classmethod
+    def open(cls, shared_dir=SHARED_DIR):
+        """
+        Returns the current generation in shared_dir, or None if nothing of this format version has been published.
+        """
+        generation = current_generation(shared_dir)
+        if generation is None:
+            return None
+
+        generation_dir = os.path.join(shared_dir, f"{generation:06d}")
+        try:
+            with open(os.path.join(generation_dir, MANIFEST_FILE)) as file:
+                manifest = json.load(file)
+        except (OSError, ValueError):
+            return None
+
+        if manifest.get('version') != SHARED_VERSION:
+            return None
+        return cls(generation_dir, manifest)
+
+    def frame(self, name):
+        frame_dir = os.path.join(self.generation_dir, name)
+        columns = {column['name']: read_column(frame_dir, column) for column in self.manifest['frames'][name]['columns']}
+        return pd.DataFrame(columns, copy=False)
+
+    def array(self, name):
+        return np.load(os.path.join(self.generation_dir, f"{name}.npy"), mmap_mode='r')
+
+if __name__ == '__main__':
+    import data_management
+    from retraining import RetrainScheduler
+
+    parser = argparse.ArgumentParser(description="Load the data once and publish it to a shared store that worker processes attach to")
+    parser.add_argument('--shared-dir', default=SHARED_DIR, help="Directory to publish to, e.g. under /dev/shm to keep it in memory")
+    parser.add_argument('--models-dir', default=MODELS_DIR, help="Directory holding the model artifacts")
+    parser.add_argument('--compact', action='store_true', help="Load in compact mode")
+    parser.add_argument('--watch', action='store_true', help="Keep running, retraining and publishing a new generation as ratings come in")
+    parser.add_argument('--retrain-threshold', type=int, default=1000, help="New ratings that trigger a retrain when watching")
+    parser.add_argument('--retrain-interval', type=int, default=24 * 60 * 60, help="Seconds after which to retrain when watching")
+    parser.add_argument('--poll-interval', type=int, default=60, help="Seconds between checks when watching")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    data_management.data = data_management.DataManager(models_dir=args.models_dir, compact=args.compact)
+    generation = publish_data(data_management.data, args.shared_dir, args.models_dir)
+    print(f"Published generation {generation} to {args.shared_dir} in {time.perf_counter() - start:.2f}s")
+
+    if args.watch:
+        RetrainScheduler(models_dir=args.models_dir, threshold=args.retrain_threshold, interval=args.retrain_interval,
+                         poll_interval=args.poll_interval, publish_dir=args.shared_dir).run()
@@ -0,0 +1,179 @@
+import argparse
+import hashlib
+import json
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+from publishing import staged_dir
+
+SNAPSHOT_VERSION = 2
+SNAPSHOT_DIR = "Data/snapshot"
+MANIFEST_FILE = "manifest.json"
+
+# CSV files each snapshotted frame is built from, relative to the data directory
+SOURCES = {
+    'recipes': ["Recipes.csv", "Recipe_Bayesian_Ratings.csv"],
+    'interactions': ["Interactions.csv"],
+    'exercises': ["Exercises.csv"],
+}
+
+def read_source_csv(name, data_dir="Data"):
+    """
+    Parses a snapshotted frame from its source CSV files.
+    """
+    match name:
+        case 'recipes':
+            return pd.merge(pd.read_csv(os.path.join(data_dir, "Recipes.csv")), pd.read_csv(os.path.join(data_dir, "Recipe_Bayesian_Ratings.csv")),
+                            how='left', left_on='id', right_on='id', suffixes=(False, False))
+        case 'interactions':
+            return pd.read_csv(os.path.join(data_dir, "Interactions.csv"))
+        case 'exercises':
+            return pd.read_csv(os.path.join(data_dir, "Exercises.csv"))
+    raise ValueError(f"Unknown snapshot source: {name}")
+
+def file_checksum(path):
+    checksum = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1 << 20), b''):
+            checksum.update(chunk)
+    return checksum.hexdigest()
+
+def read_source_column(name, column, data_dir="Data"):
+    """
+    Parses a single column of a snapshotted frame from its source CSV files.
+    """
+    if name == 'recipes' and column != 'bayesian_avg':
+        return pd.read_csv(os.path.join(data_dir, "Recipes.csv"), usecols=[column])[column]
+    return read_source_csv(name, data_dir)[column]
+
+def source_checksums(data_dir="Data"):
+    return {file: file_checksum(os.path.join(data_dir, file)) for files in SOURCES.values() for file in files}
+
+def write_column(frame_dir, position, series):
+    """
+    Writes one column and returns its manifest entry.
+
+    Numeric columns are written as .npy files that can be memory-mapped. String columns are written as
+    one UTF-8 blob with byte offsets and a null mask, so single rows can be decoded straight from the mapped blob.
+    """
+    base = os.path.join(frame_dir, f"column_{position:03d}")
+    if not pd.api.types.is_numeric_dtype(series.dtype):
+        values = series.to_numpy()
+        nulls = pd.isna(values)
+        encoded = [b'' if null else str(value).encode('utf-8') for value, null in zip(values, nulls)]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(value) for value in encoded], out=offsets[1:])
+        with open(base + ".utf8", 'wb') as file:
+            file.write(b''.join(encoded))
+        np.save(base + ".offsets.npy", offsets)
+        np.save(base + ".nulls.npy", nulls)
+        return {'name': series.name, 'kind': 'string', 'file': os.path.basename(base)}
+
+    np.save(base + ".npy", series.to_numpy())
+    return {'name': series.name, 'kind': 'numeric', 'file': os.path.basename(base)}
+
+def read_column(frame_dir, column, mmap=True, rows=None):
+    """
+    Reads a column written by write_column, or only the given positional rows of it.
+    """
+    base = os.path.join(frame_dir, column['file'])
+    if column['kind'] == 'numeric':
+        values = np.load(base + ".npy", mmap_mode='r' if mmap else None)
+        return values if rows is None else np.asarray(values[rows])
+
+    offsets = np.load(base + ".offsets.npy", mmap_mode='r')
+    nulls = np.load(base + ".nulls.npy", mmap_mode='r')
+    if rows is None:
+        with open(base + ".utf8", 'rb') as file:
+            blob = file.read()
+        rows = np.arange(len(offsets) - 1)
+    else:
+        # Only the requested rows are paged in from the mapped blob
+        rows = np.asarray(rows)
+        blob = np.memmap(base + ".utf8", dtype=np.uint8, mode='r') if offsets[-1] > 0 else b''
+
+    starts = offsets[rows].tolist()
+    stops = offsets[rows + 1].tolist()
+    values = np.empty(len(starts), dtype=object)
+    values[:] = [bytes(blob[start:stop]).decode('utf-8') for start, stop in zip(starts, stops)]
+    values[np.asarray(nulls[rows], dtype=bool)] = np.nan
+    return values
+
+def build_snapshot(data_dir="Data", snapshot_dir=SNAPSHOT_DIR):
+    """
+    Parses the source CSVs and writes them as a versioned binary snapshot.
+    """
+    manifest = {'version': SNAPSHOT_VERSION, 'created': time.time(), 'sources': source_checksums(data_dir), 'frames': {}}
+    with staged_dir(snapshot_dir) as staging_dir:
+        for name in SOURCES:
+            frame = read_source_csv(name, data_dir)
+            frame_dir = os.path.join(staging_dir, name)
+            os.makedirs(frame_dir)
+            manifest['frames'][name] = {
+                'rows': len(frame),
+                'columns': [write_column(frame_dir, position, frame[column]) for position, column in enumerate(frame.columns)],
+            }
+
+        with open(os.path.join(staging_dir, MANIFEST_FILE), 'w') as file:
+            json.dump(manifest, file, indent=2)
+    return manifest
+
+class Snapshot:
+    """
+    A binary snapshot of the data directory whose numeric columns are memory-mapped on load.
+    """
+    def __init__(self, snapshot_dir, manifest) -> None:
+        self.snapshot_dir = snapshot_dir
+        self.manifest = manifest
+
+    @classmethod
+    def open(cls, snapshot_dir=SNAPSHOT_DIR, data_dir="Data"):
+        """
+        Returns the snapshot in snapshot_dir, or None if it is missing, of another format version,
+        or was built from CSVs that have since changed.
+        """
+        try:
+            with open(os.path.join(snapshot_dir, MANIFEST_FILE)) as file:
+                manifest = json.load(file)
+        except (OSError, ValueError):
+            return None
+
+        if manifest.get('version') != SNAPSHOT_VERSION:
+            return None
+
+        try:
+            if manifest.get('sources') != source_checksums(data_dir):
+                return None
+        except OSError:
+            return None
+
+        return cls(snapshot_dir, manifest)
+
+    def frame(self, name, mmap=True, skip=()):
+        frame_manifest = self.manifest['frames'][name]
+        frame_dir = os.path.join(self.snapshot_dir, name)
+        columns = {column['name']: read_column(frame_dir, column, mmap=mmap)
+                   for column in frame_manifest['columns'] if column['name'] not in skip}
+        return pd.DataFrame(columns, copy=False)
+
+    def column(self, name, column_name, rows=None):
+        frame_dir = os.path.join(self.snapshot_dir, name)
+        for column in self.manifest['frames'][name]['columns']:
+            if column['name'] == column_name:
+                return read_column(frame_dir, column, rows=rows)
+        raise KeyError(column_name)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Build a binary snapshot of the data directory for fast startup")
+    parser.add_argument('--data-dir', default="Data", help="Directory holding the source CSV files")
+    parser.add_argument('--snapshot-dir', default=SNAPSHOT_DIR, help="Directory to write the snapshot to")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    manifest = build_snapshot(args.data_dir, args.snapshot_dir)
+    for name, frame in manifest['frames'].items():
+        print(f"{name}: {frame['rows']} rows, {len(frame['columns'])} columns")
+    print(f"Snapshot written to {args.snapshot_dir} in {time.perf_counter() - start:.2f}s")
@@ -0,0 +1,109 @@
+import os
+import threading
+
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.exc import OperationalError
+
+DATABASE_PATH = os.environ.get('DATABASE_PATH', "instance/smartshop.db")
+
+ENGINE_OPTIONS = {
+    'pool_size': 10,
+    'max_overflow': 20,
+    'connect_args': {'timeout': 30, 'check_same_thread': False},
+}
+
+# Set on every new connection. WAL lets readers run alongside a writer, and busy_timeout makes
+# concurrent writers wait for each other instead of failing with "database is locked"
+SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'busy_timeout': 5000,
+    'cache_size': -64000,
+    'temp_store': 'MEMORY',
+    'mmap_size': 256 * 2 ** 20,
+}
+
+# Per-table database files used before the tables were consolidated into one database
+LEGACY_DATABASES = {
+    'users': "user_database.db",
+    'recipe_ratings': "recipe_ratings.db",
+    'exercise_ratings': "exercise_ratings.db",
+}
+
+_engine = None
+_engine_lock = threading.Lock()
+
+def database_url(path=DATABASE_PATH):
+    return f"sqlite:///{os.path.abspath(path)}"
+
+def make_database_dir(path=DATABASE_PATH):
+    """
+    Creates the directory of the database file. SQLite does not create it, and Flask-SQLAlchemy
+    only creates the instance folder for relative database paths.
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    for name, value in SQLITE_PRAGMAS.items():
+        cursor.execute(f"PRAGMA {name}={value}")
+    cursor.close()
+
+def get_engine():
+    """
+    Returns the process-wide engine for the consolidated database, creating it on first use.
+    """
+    global _engine
+    with _engine_lock:
+        if _engine is None:
+            make_database_dir()
+            _engine = create_engine(database_url(), **ENGINE_OPTIONS)
+            event.listen(_engine, 'connect', set_sqlite_pragmas)
+        return _engine
+
+def use_engine(engine):
+    """
+    Makes engine, such as Flask-SQLAlchemy's, the one get_engine returns, so the app and the data loaders share one pool.
+
+    Connections already in the pool were opened without the pragmas, so the pool is emptied.
+    """
+    global _engine
+    with _engine_lock:
+        if not event.contains(engine, 'connect', set_sqlite_pragmas):
+            event.listen(engine, 'connect', set_sqlite_pragmas)
+            engine.dispose()
+        _engine = engine
+
+def import_legacy_databases(engine, instance_dir="instance"):
+    """
+    Copies the rows of the former per-table database files into the consolidated database.
+
+    A table is only imported while it is still empty, so this is safe to run on every start.
+
+    Returns:
+        dict: Number of rows imported into each table.
+    """
+    imported = {}
+    for table, file_name in LEGACY_DATABASES.items():
+        path = os.path.join(instance_dir, file_name)
+        if not os.path.exists(path):
+            continue
+
+        with engine.begin() as connection:
+            if connection.execute(text(f"SELECT 1 FROM {table} LIMIT 1")).first() is not None:
+                continue
+            legacy_engine = create_engine(database_url(path))
+            try:
+                with legacy_engine.connect() as legacy_connection:
+                    rows = [dict(row) for row in legacy_connection.execute(text(f"SELECT * FROM {table}")).mappings()]
+            except OperationalError:
+                # The legacy file exists but never had the table created
+                rows = []
+            finally:
+                legacy_engine.dispose()
+            if rows:
+                columns = list(rows[0])
+                connection.execute(text(f"INSERT OR IGNORE INTO {table} ({', '.join(columns)}) "
+                                        f"VALUES ({', '.join(':' + column for column in columns)})"), rows)
+            imported[table] = len(rows)
+    return imported
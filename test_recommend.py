@@ -0,0 +1,127 @@
+import unittest
+from unittest import mock
+
+import numpy as np
+import pandas as pd
+from surprise import Dataset, Reader, SVD
+
+import recommend
+from indexes import NUTRIENT_COLUMNS, TAG_MATCH_SUBSTRING, NutrientIndex, TagIndex
+from model_store import SVD_PARAMS, FactorModel
+
+TAGS = ['breakfast', 'winter', 'vegan', 'dessert']
+TIME_TAGS = ['winter', 'breakfast']
+UNKNOWN_USER = 999
+
+def make_recipes(rng, n_recipes=300):
+    # Tags are sparse enough that few recipes carry both time tags, so the order of the time contexts matters
+    recipes = pd.DataFrame({
+        'id': np.arange(1, n_recipes + 1) * 3,
+        'bayesian_avg': rng.permutation(n_recipes) * 5.0 / n_recipes,
+        'tags': [str([tag for tag in TAGS if rng.random() < 0.15]) for _ in range(n_recipes)],
+    })
+    for column in NUTRIENT_COLUMNS:
+        recipes[column] = rng.uniform(0, 1000 if column == 'calories' else 120, n_recipes).round(1)
+    return recipes
+
+def train(recipes, rng, **params):
+    """
+    Fits a Surprise SVD on random ratings of most recipes, and returns it with its FactorModel.
+    """
+    rated_ids = recipes['id'].to_numpy()[:-20]
+    ratings = pd.DataFrame([(user_id, recipe_id, int(rng.integers(0, 6)))
+                            for user_id in range(1, 31) for recipe_id in rng.choice(rated_ids, 40, replace=False)],
+                           columns=['user_id', 'id', 'rating'])
+    trainset = Dataset.load_from_df(ratings, Reader(rating_scale=(0, 5))).build_full_trainset()
+    svd = SVD(**{**SVD_PARAMS, 'n_factors': 4, 'n_epochs': 10, **params})
+    svd.fit(trainset)
+    return svd, FactorModel.from_svd(svd)
+
+def recursive_ranking(recipes, scores, tags, time_tags):
+    """
+    Ranks the recipes carrying every tag by score the way getRecipesWithConfiguration did before its time
+    context was made single-pass: by calling itself once per time tag and putting the best two of those first.
+    """
+    tags_filter = pd.Series(True, index=recipes.index)
+    for tag in tags:
+        tags_filter &= recipes['tags'].str.contains(tag, case=False)
+    recipes_found_sorted = recipes[tags_filter].assign(score=scores[tags_filter.to_numpy()]).sort_values(by='score', ascending=False, kind='stable')
+
+    recipes_with_time_context = [recursive_ranking(recipes, scores, tags + [tag], time_tags)[:5] for tag in time_tags if tag not in tags]
+    if recipes_with_time_context == []:
+        return recipes_found_sorted
+    recipes_with_time_context = pd.concat(recipes_with_time_context, ignore_index=True)
+    return pd.concat([recipes_with_time_context[:2], recipes_found_sorted], ignore_index=True).drop_duplicates()
+
+class ColabPredictionTest(unittest.TestCase):
+    """
+    The vectorized predictions give what SVD.predict gives one item at a time.
+    """
+    def check_predictions(self, **params):
+        rng = np.random.default_rng(0)
+        recipes = make_recipes(rng)
+        svd, colab_filter = train(recipes, rng, **params)
+        item_ids = np.concatenate([recipes['id'].to_numpy(), [-1, 10 ** 6]])
+        user_ids = [1, 7, 30, UNKNOWN_USER]
+
+        expected = np.array([[svd.predict(user_id, item_id).est for item_id in item_ids] for user_id in user_ids])
+        for position, user_id in enumerate(user_ids):
+            np.testing.assert_allclose(recommend.predict_colab_batch(colab_filter, user_id, item_ids), expected[position], rtol=0, atol=1e-12)
+        np.testing.assert_allclose(recommend.predict_colab_matrix(colab_filter, user_ids, item_ids), expected, rtol=0, atol=1e-12)
+
+    def test_biased(self):
+        self.check_predictions(biased=True)
+
+    def test_unbiased(self):
+        self.check_predictions(biased=False)
+
+class RecipeRankingTest(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(1)
+        self.recipes = make_recipes(rng)
+        self.svd, self.colab_filter = train(self.recipes, rng)
+        self.indexes = {'tag_index': TagIndex(self.recipes['tags']), 'nutrient_index': NutrientIndex(self.recipes)}
+        get_time_tags = mock.patch.object(recommend, 'get_time_tags', return_value=list(TIME_TAGS))
+        get_time_tags.start()
+        self.addCleanup(get_time_tags.stop)
+
+    def test_time_context_matches_recursive_ranking(self):
+        """
+        The single-pass time context ranks like the recursive one did with SVD.predict scores.
+        """
+        for user_id, count in [(3, 12), (UNKNOWN_USER, 0)]:
+            for tags in ([], ['vegan'], ['breakfast']):
+                colab_filter = self.colab_filter if self.colab_filter.knows_user(user_id) else None
+                if colab_filter:
+                    predictions = np.array([self.svd.predict(user_id, recipe_id).est for recipe_id in self.recipes['id']])
+                    scores = recommend.calculate_weighted_prediction(self.recipes['bayesian_avg'].to_numpy(), predictions, count)
+                else:
+                    scores = self.recipes['bayesian_avg'].to_numpy()
+                expected = recursive_ranking(self.recipes, scores, tags, TIME_TAGS)
+
+                for indexes in ({}, self.indexes):
+                    with self.subTest(user_id=user_id, tags=tags, indexed=bool(indexes)):
+                        found = recommend.getRecipesWithConfiguration(self.recipes, user_id, count, colab_filter=colab_filter, tags=tags,
+                                                                      tag_match=TAG_MATCH_SUBSTRING, **indexes)
+                        self.assertEqual(found['id'].tolist(), expected['id'].tolist())
+                        self.assertEqual(found.index.tolist(), expected.index.tolist())
+
+    def test_batch_matches_single_user(self):
+        """
+        getRecipesForUsers ranks each user like getRecipesWithConfiguration, for known and unknown users.
+        """
+        users = [(1, 0), (2, 40), (30, 150), (UNKNOWN_USER, 0)]
+        for filters in ({}, {'calories': 400}, {'tags': ['vegan']}, {'fat': 'high', 'daily': 2500}, {'sugar': 'low', 'tags': ['dessert']}):
+            for top_k in (None, 10):
+                with self.subTest(filters=filters, top_k=top_k):
+                    batch = recommend.getRecipesForUsers(self.recipes, users, colab_filter=self.colab_filter, top_k=top_k,
+                                                         time_tags=TIME_TAGS, **self.indexes, **filters)
+                    for (user_id, count), found in zip(users, batch):
+                        colab_filter = self.colab_filter if self.colab_filter.knows_user(user_id) else None
+                        single = recommend.getRecipesWithConfiguration(self.recipes, user_id, count, colab_filter=colab_filter,
+                                                                       top_k=top_k, **self.indexes, **filters)
+                        self.assertEqual(found['id'].tolist(), single['id'].tolist())
+                        self.assertEqual(found.index.tolist(), single.index.tolist())
+
+if __name__ == '__main__':
+    unittest.main()
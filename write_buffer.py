@@ -0,0 +1,122 @@
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+class RatingWriteBuffer:
+    """
+    Write-behind buffer for ratings, flushed to the database in batches by a background thread.
+
+    Ratings are keyed on (kind, user id, item id), so repeated ratings of an item waiting in the buffer
+    are coalesced into the latest one. The buffer is flushed every flush_interval seconds, or as soon as
+    max_pending ratings are waiting, which bounds how many acknowledged ratings a crash can lose.
+
+    write is called with a dict of kind to a list of (user id, item id, rating) rows and must write
+    them in one transaction. If it fails, the rows go back into the buffer unless a newer rating of
+    the same item arrived meanwhile, and are retried on the next flush.
+    """
+    def __init__(self, write, flush_interval=1.0, max_pending=500) -> None:
+        self.write = write
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.pending = {}
+        self.oldest_pending_at = None
+        self.enqueued = 0
+        self.coalesced = 0
+        self.flushes = 0
+        self.flushed_ratings = 0
+        self.failures = 0
+        self.last_flush_seconds = None
+        self.max_flush_seconds = None
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self._flush_requested = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self.run, name="rating-flusher", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """
+        Stops the flusher and drains whatever is still buffered.
+        """
+        self._stop.set()
+        self._flush_requested.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush()
+
+    def add(self, kind, user_id, item_id, rating):
+        with self.lock:
+            key = (kind, user_id, item_id)
+            if key in self.pending:
+                self.coalesced += 1
+            elif not self.pending:
+                self.oldest_pending_at = time.monotonic()
+            self.pending[key] = rating
+            self.enqueued += 1
+            if len(self.pending) >= self.max_pending:
+                self._flush_requested.set()
+
+    def run(self):
+        while not self._stop.is_set():
+            self._flush_requested.wait(self.flush_interval)
+            self._flush_requested.clear()
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("Flushing buffered ratings failed")
+
+    def flush(self):
+        """
+        Writes everything buffered so far. Returns the number of ratings written.
+        """
+        with self.flush_lock:
+            with self.lock:
+                batch, self.pending = self.pending, {}
+                self.oldest_pending_at = None
+            if not batch:
+                return 0
+
+            rows = {}
+            for (kind, user_id, item_id), rating in batch.items():
+                rows.setdefault(kind, []).append((user_id, item_id, rating))
+
+            start = time.perf_counter()
+            try:
+                self.write(rows)
+            except Exception:
+                self.failures += 1
+                with self.lock:
+                    for key, rating in batch.items():
+                        self.pending.setdefault(key, rating)
+                    if self.pending and self.oldest_pending_at is None:
+                        self.oldest_pending_at = time.monotonic()
+                raise
+
+            self.last_flush_seconds = time.perf_counter() - start
+            self.max_flush_seconds = max(self.max_flush_seconds or 0, self.last_flush_seconds)
+            self.flushes += 1
+            self.flushed_ratings += len(batch)
+            return len(batch)
+
+    def stats(self):
+        with self.lock:
+            depth = len(self.pending)
+            oldest_age = time.monotonic() - self.oldest_pending_at if self.oldest_pending_at is not None else None
+        return {
+            'queue_depth': depth,
+            'oldest_pending_seconds': oldest_age,
+            'enqueued': self.enqueued,
+            'coalesced': self.coalesced,
+            'flushes': self.flushes,
+            'flushed_ratings': self.flushed_ratings,
+            'failures': self.failures,
+            'last_flush_seconds': self.last_flush_seconds,
+            'max_flush_seconds': self.max_flush_seconds,
+        }